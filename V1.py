@@ -1,13 +1,56 @@
 import requests
 import json
+import logging
+import logging.handlers
 import time
 import base64
+import hashlib
+import math
 import os
+import queue
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import tracemalloc
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from urllib import parse
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from PIL import Image, features
 from io import BytesIO
 from datetime import datetime, timedelta
 
+try:
+    import resource  # 仅类Unix系统可用，用于读取进程RSS峰值
+except ImportError:
+    resource = None
+
+# 可选的AVIF/HEIC解码插件：安装后在本地解码，不再依赖CDN的URL转换
+try:
+    import pillow_avif  # noqa: F401  导入即注册AVIF解码器
+except ImportError:
+    pillow_avif = None
+
+try:
+    import pillow_heif
+
+    pillow_heif.register_heif_opener()
+    if hasattr(pillow_heif, 'register_avif_opener'):
+        pillow_heif.register_avif_opener()
+except ImportError:
+    pillow_heif = None
+
+# 可选的JSON库：安装后请求体序列化和响应解析都改用orjson
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ==================== 禁用系统代理 ====================
 os.environ['NO_PROXY'] = '*'
 os.environ['no_proxy'] = '*'
@@ -39,47 +82,1419 @@ SUPPLIER_NAME_TO_CODE = {
     "Sain xu": "LY-SP00002"
 }
 
-# 默认消息内容
-DEFAULT_MESSAGE = ("Your quotation has been completed. We are waiting for the supplier to provide product "
-                   "real-shot pictures and the size chart, which will ensure we offer you the most accurate "
-                   "and clear product information. We will upload them as soon as we receive the physical "
-                   "product images from the factory. Thank you for your understanding.")
+# 默认消息内容
+DEFAULT_MESSAGE = ("Your quotation has been completed. We are waiting for the supplier to provide product "
+                   "real-shot pictures and the size chart, which will ensure we offer you the most accurate "
+                   "and clear product information. We will upload them as soon as we receive the physical "
+                   "product images from the factory. Thank you for your understanding.")
+
+# 国家代码映射（处理不同格式的国家代码）
+COUNTRY_CODE_MAPPING = {
+    "UK/GB": "GB",
+    "UK": "GB",
+    "United Kingdom": "GB",
+    "USA": "US",
+    "United States": "US",
+    "UAE": "AE",
+    "Australia": "AU",
+    "New Zealand": "NZ",
+    "Ireland": "IE",
+    "Canada": "CA",
+    "Singapore": "SG"
+}
+
+# 循环配置
+LOOP_INTERVAL = 30  # 没有新任务时第一次等待的时间（秒），之后按倍数退避
+POLL_BUSY_INTERVAL = 0  # 有新任务时两轮之间的等待时间（秒），0为立即开始下一轮
+POLL_MAX_INTERVAL = 300  # 空闲退避的等待上限（秒）
+POLL_BACKOFF_FACTOR = 2  # 连续空闲时等待时间的增长倍数
+
+# 任务列表查询窗口与分级轮询
+TASK_LOOKBACK_DAYS = 3  # 查询最近几天的任务（含今天）
+DAY_POLL_INTERVALS = [0, 300, 900]  # 第N天（0=今天）任务列表的最小查询间隔（秒），超出长度的天数使用最后一个值
+TASK_RETRY_INTERVAL = 600  # 内容未变化、尚未完成的任务，距上次处理超过该时间才重新处理（秒）
+
+# HTTP连接池配置（每个上游一个共享Session：SP v2、内部API、图片CDN）
+HTTP_POOL_CONNECTIONS = 4  # 每个Session缓存的host连接池数量
+HTTP_POOL_MAXSIZE = 16  # 每个host最多保持的空闲连接数
+HTTP_KEEP_ALIVE = True  # 是否复用TCP/TLS连接（False则每次请求后关闭连接）
+
+# 执行模式配置
+EXECUTION_MODE = "sync"  # "sync": 逐个处理任务; "async": asyncio并发处理任务; "pipeline": 报价任务分阶段流水线处理
+ASYNC_TASK_CONCURRENCY = 4  # async模式下同时处理的任务数
+PIPELINE_QUEUE_SIZE = 1  # pipeline模式下阶段之间的队列容量（限制同时持有图片等中间结果的任务数）
+SP_API_CONCURRENCY = 4  # SP v2 API同时进行的请求数上限
+INTERNAL_API_CONCURRENCY = 8  # 内部API同时进行的请求数上限
+
+# 限流配置（令牌桶，所有任务共享）：每秒平均请求数 + 允许的突发请求数
+SP_API_RATE = 2.0
+SP_API_BURST = 5
+INTERNAL_API_RATE = 10.0
+INTERNAL_API_BURST = 20
+
+# 实拍图下载配置
+IMAGE_DOWNLOAD_WORKERS = 6  # 单个任务内并行下载/转码图片的线程数
+IMAGE_PER_HOST_CONCURRENCY = 3  # 同一CDN host同时下载的图片数上限
+
+# 图片磁盘缓存配置（缓存编码后的最终图片，按URL和内容哈希索引）
+IMAGE_CACHE_ENABLED = True
+IMAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_cache")
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 缓存总大小上限，超出按LRU淘汰
+IMAGE_CACHE_TTL = 7 * 24 * 3600  # 缓存有效期（秒）
+
+# 图片直通配置：JPEG/PNG且透明规则已满足时直接上传原始字节，不经PIL解码再编码
+IMAGE_PASSTHROUGH_ENABLED = True
+IMAGE_PASSTHROUGH_MAX_BYTES = 2 * 1024 * 1024  # 超过该大小的图片仍走PIL重新编码
+
+# 图片体积预算：超出时缩小尺寸、降低JPEG质量，直到满足预算
+IMAGE_MAX_DIMENSION = 2048  # 长边最大像素
+IMAGE_MIN_DIMENSION = 640  # 为满足预算缩小尺寸时的长边下限
+IMAGE_MAX_BYTES = 1536 * 1024  # 单张图片上限（编码后字节）
+MESSAGE_MAX_IMAGE_BYTES = 20 * 1024 * 1024  # 单条消息所有图片合计上限（编码后字节，base64后约再增大1/3）
+IMAGE_JPEG_MAX_QUALITY = 95
+IMAGE_JPEG_MIN_QUALITY = 50
+
+# 消息上传配置
+UPLOAD_SPOOL_MAX_MEMORY = 8 * 1024 * 1024  # 请求体超过该大小时转存到临时文件
+UPLOAD_BASE64_CHUNK = 3 * 256 * 1024  # 每次base64编码的原始字节数（需为3的倍数）
+TRACK_TASK_MEMORY = False  # 统计并输出每个任务的内存峰值（tracemalloc，开启期间所有分配都会变慢，仅排查问题时使用）
+
+# 报价提交：与产品详情中已有的报价对比
+QUOTATION_SKIP_UNCHANGED = False  # SP上已是相同报价（所有字段和价格一致且无需删除变体）时跳过提交（详情变体需带 pcs_{数量} 字段）
+QUOTATION_REQUEST_ONLY_FIELDS = ("is_new_price_submitted",)  # 报价参数中只控制本次请求、不保存在产品上的字段，不参与对比
+
+# SP产品信息缓存（进程内，get-products 按产品ID查询的结果）
+PRODUCT_CACHE_TTL = 300  # 缓存有效期（秒）
+PRODUCT_CACHE_MAX_SIZE = 1000  # 最多缓存的产品数，超出按LRU淘汰
+
+# 标题搜索结果缓存（进程内，报价任务和不可报价任务共用）
+TITLE_SEARCH_CACHE_TTL = 120  # 有结果时的缓存有效期（秒）
+TITLE_SEARCH_NEGATIVE_TTL = 60  # 搜索结果为空时的缓存有效期（秒），不超过有结果时的有效期，SP上新出现的产品能尽快被找到
+TITLE_SEARCH_CACHE_MAX_SIZE = 500
+
+# 本地状态数据库（SQLite）：Keer产品ID → SP产品ID映射等
+LOCAL_STATE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serv_qoute_state.sqlite3")
+
+# 任务状态回写队列（outbox）：状态先写入本地数据库，由后台线程批量回写内部系统
+STATUS_OUTBOX_BATCH_SIZE = 50  # 每次回写的最大条数
+STATUS_OUTBOX_DRAIN_INTERVAL = 5  # 后台线程空闲时的检查间隔（秒）
+STATUS_OUTBOX_RETRY_BASE = 10  # 回写失败后的首次重试间隔（秒），之后逐次翻倍
+STATUS_OUTBOX_RETRY_MAX = 600  # 重试间隔上限（秒）
+
+# 本地完成记录：已成功处理的任务在内部系统更新前再次返回时直接跳过
+COMPLETION_LEDGER_RETENTION = 7 * 24 * 3600  # 完成记录保留时间（秒），超过任务查询窗口即可
+
+# 日志
+LOG_LEVEL = "INFO"  # "DEBUG": 额外输出请求参数、响应内容、逐条报价等明细; "INFO"; "WARNING"; "ERROR"
+LOG_QUIET = False  # 高吞吐模式：只输出每个任务一行汇总和每轮汇总（忽略 LOG_LEVEL）
+LOG_JSON = False  # 每条日志输出为一行JSON（便于日志系统检索）
+LOG_BODY_MAX_CHARS = 500  # 响应内容等长文本在日志中的最大长度，超出部分截断
+
+# 图片下载请求头（模拟浏览器，部分CDN会校验Referer）
+IMAGE_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate',
+    'Referer': 'https://www.1688.com/',
+}
+
+
+# ==================== JSON编解码 ====================
+
+JSON_BODY_HEADERS = {"Content-Type": "application/json"}
+
+
+def json_loads(data):
+    """
+    解析JSON（str 或 bytes），安装了orjson时使用orjson
+    解析失败抛出 json.JSONDecodeError（orjson的异常是其子类）
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _reject_non_finite(obj):
+    """
+    数据中有 NaN / Infinity 时抛出 ValueError（orjson会输出为null，不会报错）
+    """
+    if isinstance(obj, float):
+        if not math.isfinite(obj):
+            raise ValueError(f"Out of range float values are not JSON compliant: {obj!r}")
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _reject_non_finite(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _reject_non_finite(value)
+
+
+def json_dumps_bytes(obj):
+    """
+    序列化为紧凑的UTF-8 JSON字节串（两种实现输出一致：不转义中文、无多余空格）
+    与 requests 的 json= 参数一样，NaN / Infinity 抛出 ValueError，不会作为报价发送
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        # orjson把 NaN / Infinity 输出为null：输出中没有null时不需要再检查
+        if b'null' in data:
+            _reject_non_finite(obj)
+        return data
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), allow_nan=False).encode('utf-8')
+
+
+def json_request(payload):
+    """
+    JSON请求体参数，代替 requests 的 json= 参数：session.post(url, **json_request(payload))
+    """
+    return {"data": json_dumps_bytes(payload), "headers": JSON_BODY_HEADERS}
+
+
+def json_response(response):
+    """
+    解析响应体，代替 response.json()
+    """
+    return json_loads(response.content)
+
+
+# ==================== 日志 ====================
+
+# 任务汇总级别：高于ERROR，LOG_QUIET=True 时只输出这一级别
+SUMMARY = 45
+logging.addLevelName(SUMMARY, "SUMMARY")
+
+log = logging.getLogger("serv_qoute")
+
+# 当前线程正在处理的任务，写入每条日志的 task 字段
+_log_context = threading.local()
+_log_listener = None
+
+
+def set_log_task(label):
+    """
+    设置当前线程的任务标识（None 表示不在任务中）
+    """
+    _log_context.task = label
+
+
+class TaskLogFilter(logging.Filter):
+    """
+    在调用线程中给日志记录加上当前任务标识
+    """
+
+    def filter(self, record):
+        record.task = getattr(_log_context, 'task', None) or '-'
+        return True
+
+
+class LogTruncated:
+    """
+    日志参数：只有日志实际输出时才转为字符串，并截断到 LOG_BODY_MAX_CHARS
+    用法: log.debug("响应: %s", LogTruncated(response.text))
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def _text(self):
+        return str(self.value)
+
+    def __str__(self):
+        text = self._text()
+        if len(text) <= LOG_BODY_MAX_CHARS:
+            return text
+        return f"{text[:LOG_BODY_MAX_CHARS]}...(已截断，共 {len(text)} 字符)"
+
+
+class LazyJson(LogTruncated):
+    """
+    日志参数：输出时才序列化为JSON（不转义中文），同样按 LOG_BODY_MAX_CHARS 截断
+    """
+    __slots__ = ()
+
+    def _text(self):
+        return json.dumps(self.value, ensure_ascii=False, default=str)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "task": getattr(record, 'task', '-'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """
+    配置日志输出
+
+    - 调用方只把日志记录放入内存队列（QueueHandler，不等待终端/文件IO）
+    - 后台线程（QueueListener）负责格式化并写到标准输出
+    - 低于当前级别的日志不会格式化参数（调用处统一使用 %s 占位符）
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_JSON:
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(task)s] %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TaskLogFilter())
+
+    log.addHandler(queue_handler)
+    log.setLevel(SUMMARY if LOG_QUIET else getattr(logging, LOG_LEVEL.upper(), logging.INFO))
+    log.propagate = False
+
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
+
+def stop_logging():
+    """
+    输出队列中剩余的日志并停止后台线程
+    """
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    _log_listener = None
+
+
+def log_task_summary(task_data, status, success, elapsed):
+    """
+    每个任务结束时输出一行汇总（SUMMARY级别，LOG_QUIET=True 时也会输出）
+    任务标识由 set_log_task 写入日志的 task 字段
+    """
+    log.log(SUMMARY, "%s | keer_product_id=%s | 反馈状态=%s | sp_status=%s | 耗时 %.2f秒",
+            '✅ 成功' if success else '❌ 失败', task_data.get('keer_product_id'),
+            status.fields.get('quotation_feedback_status', '-'), status.fields.get('sp_status', '-'), elapsed)
+
+
+# ==================== HTTP客户端（连接池） ====================
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+# 每个上游的并发请求上限（图片CDN不在此限制）
+_upstream_semaphores = {
+    'sp': threading.BoundedSemaphore(SP_API_CONCURRENCY),
+    'internal': threading.BoundedSemaphore(INTERNAL_API_CONCURRENCY),
+}
+
+
+class TokenBucket:
+    """
+    令牌桶限流器（线程安全）
+
+    rate: 每秒补充的令牌数；burst: 桶容量（允许的突发请求数）
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        获取一个令牌，令牌不足时阻塞等待
+
+        返回: 等待的秒数
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+
+# 每个上游共享的令牌桶（图片CDN不限流）
+_upstream_rate_limiters = {
+    'sp': TokenBucket(SP_API_RATE, SP_API_BURST),
+    'internal': TokenBucket(INTERNAL_API_RATE, INTERNAL_API_BURST),
+}
+
+
+class LimitedSession(requests.Session):
+    """
+    请求前先通过上游令牌桶限流、再获取上游信号量的Session
+    多个任务并发时限制同一上游的请求速率和同时请求数
+    """
+
+    def __init__(self, semaphore=None, rate_limiter=None):
+        super().__init__()
+        self.semaphore = semaphore
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        if self.semaphore is None:
+            return super().request(*args, **kwargs)
+        with self.semaphore:
+            return super().request(*args, **kwargs)
+
+
+def _create_http_session(default_headers=None, semaphore=None, rate_limiter=None):
+    """
+    创建带连接池的Session
+    """
+    session = LimitedSession(semaphore, rate_limiter)
+
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if default_headers:
+        session.headers.update(default_headers)
+
+    if not HTTP_KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def get_http_session(upstream, api_key=None):
+    """
+    获取上游共享的Session（懒加载，线程安全）
+
+    upstream:
+    - "sp": Service Points v2 API（认证头只在创建时设置一次，按api_key区分）
+    - "internal": 内部API (47.95.157.46:8520)
+    - "image": 图片CDN
+    """
+    key = (upstream, api_key)
+    session = _http_sessions.get(key)
+    if session is not None:
+        return session
+
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            if upstream == 'sp':
+                default_headers = {"X-Service-Point-Access-Token": api_key}
+            elif upstream == 'image':
+                default_headers = IMAGE_REQUEST_HEADERS
+            else:
+                default_headers = None
+
+            session = _create_http_session(default_headers,
+                                           _upstream_semaphores.get(upstream),
+                                           _upstream_rate_limiters.get(upstream))
+            _http_sessions[key] = session
+
+    return session
+
+
+def get_sp_session(api_key=SP_API_KEY):
+    """
+    Service Points v2 API 的共享Session
+    """
+    return get_http_session('sp', api_key)
+
+
+def get_internal_session():
+    """
+    内部API的共享Session
+    """
+    return get_http_session('internal')
+
+
+def get_image_session():
+    """
+    图片CDN的共享Session
+    """
+    return get_http_session('image')
+
+
+_image_host_semaphores = {}
+_image_host_semaphores_lock = threading.Lock()
+
+
+def get_image_host(image_url):
+    """
+    图片URL的host（小写）
+    """
+    return parse.urlsplit(image_url).netloc.lower()
+
+
+def fetch_image(image_url, timeout=30):
+    """
+    通过图片Session下载，同一CDN host的并发数受 IMAGE_PER_HOST_CONCURRENCY 限制
+    """
+    host = get_image_host(image_url)
+
+    with _image_host_semaphores_lock:
+        semaphore = _image_host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(IMAGE_PER_HOST_CONCURRENCY)
+            _image_host_semaphores[host] = semaphore
+
+    with semaphore:
+        return get_image_session().get(image_url, timeout=timeout, allow_redirects=True)
+
+
+def close_http_sessions():
+    """
+    关闭所有共享Session，释放连接池
+    """
+    with _http_sessions_lock:
+        for session in _http_sessions.values():
+            try:
+                session.close()
+            except Exception:
+                pass
+        _http_sessions.clear()
+
+
+# ==================== 图片解码能力 ====================
+
+def _detect_local_decode_formats():
+    """
+    检测PIL可以在本地解码的AVIF/HEIC格式
+    """
+    formats = set()
+
+    try:
+        if features.check_module('avif'):
+            formats.add('AVIF')  # Pillow 11.2+ 内置AVIF支持
+    except ValueError:
+        pass
+
+    if pillow_avif is not None or (pillow_heif is not None and hasattr(pillow_heif, 'register_avif_opener')):
+        formats.add('AVIF')
+    if pillow_heif is not None:
+        formats.add('HEIC')
+
+    return formats
+
+
+LOCAL_DECODE_FORMATS = _detect_local_decode_formats()
+
+
+# ==================== 图片磁盘缓存 ====================
+
+# 编码参数变化时缓存键随之变化，避免复用旧参数编码的结果
+IMAGE_ENCODE_PROFILE = (f"jpeg-q{IMAGE_JPEG_MIN_QUALITY}-{IMAGE_JPEG_MAX_QUALITY}-opt|png-opt-quantize-flatten|"
+                        f"dim-{IMAGE_MIN_DIMENSION}-{IMAGE_MAX_DIMENSION}|"
+                        f"passthrough-{int(IMAGE_PASSTHROUGH_ENABLED)}-{IMAGE_PASSTHROUGH_MAX_BYTES}-nometa")
+
+
+def image_content_key(data, max_bytes=None):
+    """
+    图片内容缓存键：原始字节的SHA-256 + 编码参数 + 体积预算
+    """
+    profile = f"{IMAGE_ENCODE_PROFILE}|budget-{max_bytes}"
+    profile_hash = hashlib.sha1(profile.encode('utf-8')).hexdigest()[:8]
+    return f"{hashlib.sha256(data).hexdigest()}-{profile_hash}"
+
+
+class ImageDiskCache:
+    """
+    编码后图片的磁盘缓存
+
+    - blobs/<内容键>.bin  编码后的图片字节
+    - blobs/<内容键>.json 格式信息 (format/ext/type/created_at)
+    - urls/<sha256(url)>.json URL → 内容键
+
+    超过TTL的条目视为失效；总大小超过上限时按最近访问时间(LRU)淘汰。
+    缓存读写失败只会退化为未命中，不影响任务处理。
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl, enabled=True):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.url_dir = os.path.join(cache_dir, 'urls')
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _url_path(self, image_url):
+        url_hash = hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.url_dir, f"{url_hash}.json")
+
+    def _ensure_dirs(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.url_dir, exist_ok=True)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _is_expired(self, created_at):
+        return time.time() - created_at > self.ttl
+
+    def _remove_blob(self, content_key):
+        for suffix in ('.bin', '.json'):
+            path = os.path.join(self.blob_dir, content_key + suffix)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                if suffix == '.bin' and self._total_bytes is not None:
+                    self._total_bytes -= size
+            except OSError:
+                pass
+
+    def get(self, content_key):
+        """
+        按内容键读取，未命中/过期返回None
+        """
+        if not self.enabled:
+            return None
+
+        meta_path = os.path.join(self.blob_dir, content_key + '.json')
+        blob_path = os.path.join(self.blob_dir, content_key + '.bin')
+
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+
+            if self._is_expired(meta.get('created_at', 0)):
+                with self._lock:
+                    self._remove_blob(content_key)
+                return None
+
+            with open(blob_path, 'rb') as f:
+                content = f.read()
+
+            # 更新访问时间，用于LRU淘汰
+            os.utime(blob_path, None)
+        except (OSError, ValueError):
+            return None
+
+        return {
+            "content": content,
+            "format": meta['format'],
+            "ext": meta['ext'],
+            "type": meta['type']
+        }
+
+    def get_by_url(self, image_url):
+        """
+        按URL读取，未命中/过期返回None
+        """
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._url_path(image_url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('url') != image_url or self._is_expired(entry.get('created_at', 0)):
+            return None
+
+        return self.get(entry['content_key'])
+
+    def link_url(self, image_url, content_key):
+        """
+        记录 URL → 内容键
+        """
+        if not self.enabled:
+            return
+
+        entry = {"url": image_url, "content_key": content_key, "created_at": time.time()}
+        try:
+            self._ensure_dirs()
+            self._write_atomic(self._url_path(image_url), json.dumps(entry).encode('utf-8'))
+        except OSError as e:
+            log.warning("      ⚠️  写入图片缓存索引失败: %s", e)
+
+    def put(self, image_url, content_key, encoded):
+        """
+        写入编码结果并记录URL索引，超出容量时淘汰最久未访问的条目
+        """
+        if not self.enabled:
+            return
+
+        meta = {
+            "format": encoded['format'],
+            "ext": encoded['ext'],
+            "type": encoded['type'],
+            "created_at": time.time()
+        }
+
+        try:
+            self._ensure_dirs()
+            blob_path = os.path.join(self.blob_dir, content_key + '.bin')
+            with self._lock:
+                self._load_total_bytes()
+                if os.path.exists(blob_path):
+                    self._total_bytes -= os.path.getsize(blob_path)
+                self._write_atomic(blob_path, encoded['content'])
+                self._write_atomic(os.path.join(self.blob_dir, content_key + '.json'),
+                                   json.dumps(meta).encode('utf-8'))
+                self._total_bytes += len(encoded['content'])
+
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            log.warning("      ⚠️  写入图片缓存失败: %s", e)
+            return
+
+        self.link_url(image_url, content_key)
+
+    def _load_total_bytes(self):
+        if self._total_bytes is not None:
+            return
+
+        total = 0
+        for name in os.listdir(self.blob_dir):
+            if name.endswith('.bin'):
+                try:
+                    total += os.path.getsize(os.path.join(self.blob_dir, name))
+                except OSError:
+                    pass
+        self._total_bytes = total
+
+    def _evict(self):
+        """
+        按最近访问时间淘汰，直到总大小降到上限的90%（调用方需持有锁）
+        """
+        entries = []
+        for name in os.listdir(self.blob_dir):
+            if not name.endswith('.bin'):
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.blob_dir, name)), name[:-4]))
+            except OSError:
+                pass
+
+        entries.sort()
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, content_key in entries:
+            if self._total_bytes <= target:
+                break
+            self._remove_blob(content_key)
+            evicted += 1
+
+        # 清理过期的URL索引（指向已淘汰内容的索引在读取时自然失效）
+        for name in os.listdir(self.url_dir):
+            path = os.path.join(self.url_dir, name)
+            try:
+                if self._is_expired(os.path.getmtime(path)):
+                    os.remove(path)
+            except OSError:
+                pass
+
+        log.info("      🧹 图片缓存淘汰 %s 条，当前 %s bytes", evicted, self._total_bytes)
+
+
+IMAGE_CACHE = ImageDiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL, enabled=IMAGE_CACHE_ENABLED)
+
+
+# ==================== 日期处理函数 ====================
+
+def get_date_list(days=None):
+    """
+    获取需要处理的日期列表：从今天开始往前 days 天（默认 TASK_LOOKBACK_DAYS）
+    返回格式：["2025-11-20", "2025-11-19", "2025-11-18"]
+    """
+    if days is None:
+        days = TASK_LOOKBACK_DAYS
+
+    today = datetime.now()
+    date_list = []
+
+    for i in range(days):  # 今天、昨天、前天 ...
+        date = today - timedelta(days=i)
+        date_str = date.strftime("%Y-%m-%d")
+        date_list.append(date_str)
+
+    return date_list
+
+
+def date_label(day_offset):
+    """
+    日期显示名称：0 → 今天，1 → 昨天，2 → 前天，其余 → N天前
+    """
+    if day_offset < 3:
+        return ["今天", "昨天", "前天"][day_offset]
+    return f"{day_offset}天前"
+
+
+def day_poll_interval(day_offset):
+    """
+    第 day_offset 天任务列表的最小查询间隔（秒）
+    """
+    return DAY_POLL_INTERVALS[min(day_offset, len(DAY_POLL_INTERVALS) - 1)]
+
+
+# ==================== 进程内缓存 ====================
+
+class TTLCache:
+    """
+    进程内 TTL + LRU 缓存（线程安全），带命中/未命中计数
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        读取未过期的缓存值，未命中返回default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存，ttl为None时使用默认有效期
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        作废指定key，key为None时清空缓存
+
+        返回: 是否有条目被移除
+        """
+        with self._lock:
+            if key is None:
+                removed = bool(self._data)
+                self._data.clear()
+                return removed
+            return self._data.pop(key, None) is not None
+
+    def stats_line(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        return f"{self.name}: 命中 {self.hits} / 未命中 {self.misses} ({hit_rate:.1f}%), 当前 {len(self._data)} 条"
+
+
+PRODUCT_CACHE = TTLCache("SP产品信息缓存", PRODUCT_CACHE_MAX_SIZE, PRODUCT_CACHE_TTL)
+TITLE_SEARCH_CACHE = TTLCache("标题搜索缓存", TITLE_SEARCH_CACHE_MAX_SIZE, TITLE_SEARCH_CACHE_TTL)
+
+
+def product_cache_key(api_key, product_id, is_quotation_product=2):
+    return (api_key, str(product_id), is_quotation_product)
+
+
+def invalidate_product_cache(product_id=None, api_key=SP_API_KEY, is_quotation_product=2):
+    """
+    作废SP产品信息缓存，product_id为None时清空全部
+    """
+    if product_id is None:
+        return PRODUCT_CACHE.invalidate()
+    return PRODUCT_CACHE.invalidate(product_cache_key(api_key, product_id, is_quotation_product))
+
+
+def normalize_title(title):
+    """
+    标题搜索缓存键：合并连续空白并忽略大小写
+    """
+    return ' '.join(str(title).split()).casefold()
+
+
+def print_cache_stats():
+    """
+    输出进程内缓存命中统计（累计）
+    """
+    log.info("🗃️  缓存统计 (累计):")
+    log.info("   %s", PRODUCT_CACHE.stats_line())
+    log.info("   %s", TITLE_SEARCH_CACHE.stats_line())
+
+
+# ==================== 本地状态数据库 ====================
+
+_STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keer_product_mapping (
+    keer_product_id TEXT PRIMARY KEY,
+    product_id NOT NULL,
+    supplier_name TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS status_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    keer_product_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS status_outbox_keer_product_id ON status_outbox (keer_product_id);
+
+CREATE TABLE IF NOT EXISTS completed_tasks (
+    task_type TEXT NOT NULL,
+    keer_product_id TEXT NOT NULL,
+    quotation_hash TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (task_type, keer_product_id)
+);
+"""
+
+_state_db_conn = None
+_state_db_lock = threading.RLock()
+
+
+def get_state_db():
+    """
+    本地状态数据库的共享连接（懒加载，首次使用时建表）
+    多线程共用同一连接，读写时需持有 _state_db_lock
+    """
+    global _state_db_conn
+
+    with _state_db_lock:
+        if _state_db_conn is None:
+            conn = sqlite3.connect(LOCAL_STATE_DB, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_STATE_DB_SCHEMA)
+            _state_db_conn = conn
+        return _state_db_conn
+
+
+def get_keer_mapping(keer_product_id):
+    """
+    读取本地保存的 Keer产品ID → (SP产品ID, 供应商名称)
+
+    返回:
+        命中: (product_id, supplier_name)
+        未命中: (None, None)
+    """
+    try:
+        with _state_db_lock:
+            row = get_state_db().execute(
+                "SELECT product_id, supplier_name FROM keer_product_mapping WHERE keer_product_id = ?",
+                (str(keer_product_id),)
+            ).fetchone()
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  读取本地产品映射失败: %s", e)
+        return (None, None)
+
+    if row:
+        return (row[0], row[1])
+    return (None, None)
+
+
+def save_keer_mapping(keer_product_id, product_id, supplier_name):
+    """
+    保存 Keer产品ID → (SP产品ID, 供应商名称)
+    """
+    try:
+        with _state_db_lock:
+            conn = get_state_db()
+            conn.execute(
+                "INSERT OR REPLACE INTO keer_product_mapping "
+                "(keer_product_id, product_id, supplier_name, updated_at) VALUES (?, ?, ?, ?)",
+                (str(keer_product_id), product_id, supplier_name, time.time())
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  保存本地产品映射失败: %s", e)
+
+
+def invalidate_keer_mapping(keer_product_id):
+    """
+    作废本地映射（SP报告产品不存在或供应商不一致时调用）
+    """
+    try:
+        with _state_db_lock:
+            conn = get_state_db()
+            conn.execute("DELETE FROM keer_product_mapping WHERE keer_product_id = ?", (str(keer_product_id),))
+            conn.commit()
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  作废本地产品映射失败: %s", e)
+
+
+def quotation_hash(task_data):
+    """
+    任务报价内容（quotation_result）的哈希，报价变化后需要重新处理
+    """
+    raw = json.dumps(task_data.get('quotation_result'), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def record_task_completed(task_type, task_data):
+    """
+    记录任务已成功处理（task_type, keer_product_id, 报价哈希）
+    任务状态回写成功之前，filter_completed_tasks 不会按这条记录跳过任务
+    """
+    try:
+        with _state_db_lock:
+            conn = get_state_db()
+            conn.execute(
+                "INSERT OR REPLACE INTO completed_tasks "
+                "(task_type, keer_product_id, quotation_hash, completed_at) VALUES (?, ?, ?, ?)",
+                (task_type, str(task_data.get('keer_product_id')), quotation_hash(task_data), time.time())
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  保存本地完成记录失败: %s", e)
+
+
+def filter_completed_tasks(task_type, tasks):
+    """
+    去掉本地已记录完成且报价未变化的任务（不发起任何网络请求）
+    状态回写队列中还有该 Keer产品ID 未回写成功的记录时不跳过，内部系统还不知道任务已完成
+
+    返回: (待处理任务列表, 跳过数量)
+    """
+    if not tasks:
+        return tasks, 0
+
+    try:
+        with _state_db_lock:
+            completed = dict(get_state_db().execute(
+                "SELECT keer_product_id, quotation_hash FROM completed_tasks AS completed "
+                "WHERE task_type = ? AND NOT EXISTS ("
+                "SELECT 1 FROM status_outbox WHERE status_outbox.keer_product_id = completed.keer_product_id)",
+                (task_type,)
+            ).fetchall())
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  读取本地完成记录失败: %s", e)
+        return tasks, 0
+
+    pending = [task for task in tasks
+               if completed.get(str(task.get('keer_product_id'))) != quotation_hash(task)]
+    return pending, len(tasks) - len(pending)
+
+
+def prune_completion_ledger():
+    """
+    删除超过 COMPLETION_LEDGER_RETENTION 的完成记录
+    """
+    try:
+        with _state_db_lock:
+            conn = get_state_db()
+            conn.execute("DELETE FROM completed_tasks WHERE completed_at < ?",
+                         (time.time() - COMPLETION_LEDGER_RETENTION,))
+            conn.commit()
+    except sqlite3.Error as e:
+        log.warning("   ⚠️  清理本地完成记录失败: %s", e)
+
+
+class StatusOutbox:
+    """
+    任务状态回写队列（持久化在本地状态数据库的 status_outbox 表）
+
+    - enqueue 只写本地数据库，任务处理不再等待内部API
+    - 后台线程按 id 顺序批量回写，失败的记录按指数退避重试，直到成功才删除
+    - 同一 Keer产品ID 每次只发送最早的一条，前一条成功后才发送下一条，保证顺序
+    - 程序重启后未回写的记录继续回写
+    """
+
+    KIND_SAVE = "save"
+    KIND_SP_COMPLETED = "sp_completed"
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, entries):
+        """
+        写入待回写记录
+
+        参数:
+            entries: [(keer_product_id, kind, payload_dict), ...]，按顺序写入
+        """
+        if not entries:
+            return
+
+        now = time.time()
+        rows = [(str(keer_product_id), kind, json.dumps(payload, ensure_ascii=False), now, now)
+                for keer_product_id, kind, payload in entries]
+        with _state_db_lock:
+            conn = get_state_db()
+            conn.executemany(
+                "INSERT INTO status_outbox (keer_product_id, kind, payload, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+
+        self.start()
+        self._wakeup.set()
+
+    def pending_count(self):
+        """
+        尚未回写成功的记录数
+        """
+        with _state_db_lock:
+            return get_state_db().execute("SELECT COUNT(*) FROM status_outbox").fetchone()[0]
+
+    def _next_batch(self):
+        """
+        取出本次可发送的记录：每个 Keer产品ID 只取最早的一条，且需到达重试时间
+        """
+        with _state_db_lock:
+            return get_state_db().execute(
+                "SELECT id, keer_product_id, kind, payload, attempts, next_attempt_at "
+                "FROM status_outbox "
+                "WHERE id IN (SELECT MIN(id) FROM status_outbox GROUP BY keer_product_id) "
+                "AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), STATUS_OUTBOX_BATCH_SIZE)
+            ).fetchall()
+
+    def drain_once(self):
+        """
+        回写一批记录
+
+        返回: 本次发送的记录数（0 表示当前没有可发送的记录）
+        """
+        with self._drain_lock:
+            batch = self._next_batch()
+            if not batch:
+                return 0
+
+            save_rows = [row for row in batch if row[2] == self.KIND_SAVE]
+            sp_rows = [row for row in batch if row[2] == self.KIND_SP_COMPLETED]
+
+            results = {}
+            if save_rows:
+                save_results = save_task_status_bulk([json.loads(row[3]) for row in save_rows])
+                results.update(zip((row[0] for row in save_rows), save_results))
+            if sp_rows:
+                sp_results = update_sp_status_bulk([row[1] for row in sp_rows])
+                results.update(zip((row[0] for row in sp_rows), sp_results))
+
+            now = time.time()
+            done_ids = [(row[0],) for row in batch if results.get(row[0])]
+            retry_rows = []
+            for row in batch:
+                if results.get(row[0]):
+                    continue
+                attempts = row[4] + 1
+                delay = min(STATUS_OUTBOX_RETRY_BASE * 2 ** (attempts - 1), STATUS_OUTBOX_RETRY_MAX)
+                retry_rows.append((attempts, now + delay, "回写失败", row[0]))
+
+            with _state_db_lock:
+                conn = get_state_db()
+                conn.executemany("DELETE FROM status_outbox WHERE id = ?", done_ids)
+                conn.executemany(
+                    "UPDATE status_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    retry_rows
+                )
+                conn.commit()
+
+            self.sent += len(done_ids)
+            self.failed += len(retry_rows)
+            if retry_rows:
+                log.warning("⚠️  状态回写失败 %s 条，将在退避后重试", len(retry_rows))
+            return len(batch)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception as e:
+                log.error("❌ 状态回写队列异常: %s", e)
+                sent = 0
+
+            if not sent:
+                self._wakeup.wait(STATUS_OUTBOX_DRAIN_INTERVAL)
+                self._wakeup.clear()
+
+    def start(self):
+        """
+        启动后台回写线程（已启动时不重复启动）
+        """
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="status-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, final_drain=True):
+        """
+        停止后台线程；final_drain=True 时再尝试回写一遍当前可发送的记录
+        未成功的记录保留在数据库中，下次启动后继续回写
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=60)
+
+        if final_drain:
+            while self.drain_once():
+                pass
+
+    def stats_line(self):
+        return f"状态回写队列: 已回写 {self.sent} 条, 失败重试 {self.failed} 次, 待回写 {self.pending_count()} 条"
+
+
+STATUS_OUTBOX = StatusOutbox()
+
+
+# ==================== 任务调度 ====================
+
+def task_fingerprint(task_type, task_data):
+    """
+    任务内容指纹：只取决定处理结果的字段，处理后内部系统回写的状态字段不影响指纹
+    """
+    fields = {
+        "type": task_type,
+        "keer_product_id": str(task_data.get('keer_product_id')),
+        "client_product_title": task_data.get('client_product_title'),
+        "store_code": task_data.get('store_code'),
+    }
+    if task_type == 'quotation':
+        fields["quotation_result"] = task_data.get('quotation_result')
+
+    raw = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class TaskAttemptTracker:
+    """
+    记录已经交给处理的任务，区分"新任务"、"到期重试的旧任务"和"未到重试时间的旧任务"
+
+    - 新任务（未见过或内容有变化）立即处理
+    - 内容未变化的旧任务，距上次处理超过 TASK_RETRY_INTERVAL 才重新处理
+    - 长时间未再出现的任务自动遗忘（较早日期的列表查询间隔较长，不能按轮次遗忘）
+    """
+
+    def __init__(self):
+        # (task_type, keer_product_id) → (fingerprint, handed_at, seen_at)
+        self._attempted = {}
+        self._lock = threading.Lock()
+
+    def observe(self, task_type, tasks):
+        """
+        登记本轮获取到的任务，并选出需要处理的任务
+
+        返回: (需要处理的任务列表, 其中新任务的数量)
+        """
+        now = time.time()
+        due_tasks = []
+        new_count = 0
+        with self._lock:
+            for task in tasks:
+                key = (task_type, str(task.get('keer_product_id')))
+                fingerprint = task_fingerprint(task_type, task)
+                previous = self._attempted.get(key)
+
+                if previous is None or previous[0] != fingerprint:
+                    new_count += 1
+                    due_tasks.append(task)
+                    handed_at = now
+                elif now - previous[1] >= TASK_RETRY_INTERVAL:
+                    due_tasks.append(task)
+                    handed_at = now
+                else:
+                    handed_at = previous[1]
+
+                self._attempted[key] = (fingerprint, handed_at, now)
+        return due_tasks, new_count
+
+    def end_round(self):
+        horizon = time.time() - 2 * (max(DAY_POLL_INTERVALS) + POLL_MAX_INTERVAL)
+        with self._lock:
+            self._attempted = {key: entry for key, entry in self._attempted.items() if entry[2] >= horizon}
+
+
+TASK_TRACKER = TaskAttemptTracker()
+
+
+class TaskListPoller:
+    """
+    按 (任务类型, 日期) 记录任务列表的上次查询时间和内容指纹
+
+    今天的列表每轮都查询，较早日期按 DAY_POLL_INTERVALS 降低查询频率；
+    查询失败不更新查询时间，下一轮重试
+    """
+
+    def __init__(self):
+        # (task_type, created_at) → (polled_at, list_fingerprint)
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def is_due(self, task_type, created_at, day_offset):
+        with self._lock:
+            entry = self._lists.get((task_type, created_at))
+        return entry is None or time.time() - entry[0] >= day_poll_interval(day_offset)
+
+    def record(self, task_type, created_at, tasks):
+        """
+        记录一次成功的查询
+
+        返回: 列表内容相对上次查询是否有变化
+        """
+        raw = ','.join(sorted(task_fingerprint(task_type, task) for task in tasks))
+        fingerprint = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        with self._lock:
+            previous = self._lists.get((task_type, created_at))
+            self._lists[(task_type, created_at)] = (time.time(), fingerprint)
+        return previous is None or previous[1] != fingerprint
+
+    def retain(self, date_list):
+        """
+        遗忘查询窗口之外的日期
+        """
+        with self._lock:
+            self._lists = {key: entry for key, entry in self._lists.items() if key[1] in date_list}
+
+
+TASK_LIST_POLLER = TaskListPoller()
+
+
+def fetch_task_list(task_type, fetch_func, store_code, created_at):
+    """
+    获取一个任务列表并记录查询结果
+
+    返回: (任务列表, 耗时秒数, 列表是否有变化)；查询失败时任务列表为 None
+    """
+    start = time.perf_counter()
+    result = fetch_func(store_code, created_at)
+    elapsed = time.perf_counter() - start
+
+    if result is None:
+        return None, elapsed, False
+
+    tasks = parse_task_data(result)
+    changed = TASK_LIST_POLLER.record(task_type, created_at, tasks)
+    return tasks, elapsed, changed
+
+
+def fetch_all_task_lists(sources, store_code, date_list):
+    """
+    并发获取所有到期的任务列表（每种任务 × 每个日期），逐个输出耗时
 
-# 国家代码映射（处理不同格式的国家代码）
-COUNTRY_CODE_MAPPING = {
-    "UK/GB": "GB",
-    "UK": "GB",
-    "United Kingdom": "GB",
-    "USA": "US",
-    "United States": "US",
-    "UAE": "AE",
-    "Australia": "AU",
-    "New Zealand": "NZ",
-    "Ireland": "IE",
-    "Canada": "CA",
-    "Singapore": "SG"
-}
+    参数:
+        sources: [(task_type, 显示名称, fetch_func), ...]
 
-# 循环配置
-LOOP_INTERVAL = 30  # 每轮循环完成后等待时间（秒），30秒
+    返回: {(task_type, created_at): 任务列表}，未到查询时间或查询失败的列表不包含在内
+    """
+    requests_to_send = []
+    for day_offset, created_at in enumerate(date_list):
+        for task_type, task_name, fetch_func in sources:
+            if TASK_LIST_POLLER.is_due(task_type, created_at, day_offset):
+                requests_to_send.append((day_offset, created_at, task_type, task_name, fetch_func))
+            else:
+                log.info("   ⏭️  %s (%s) %s: 距上次查询不足 %s 秒，跳过",
+                         date_label(day_offset), created_at, task_name, day_poll_interval(day_offset))
+
+    if not requests_to_send:
+        return {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(len(requests_to_send), INTERNAL_API_CONCURRENCY)) as executor:
+        futures = [executor.submit(fetch_task_list, task_type, fetch_func, store_code, created_at)
+                   for _, created_at, task_type, _, fetch_func in requests_to_send]
+        results = [future.result() for future in futures]
+    wall_time = time.perf_counter() - start
+
+    task_lists = {}
+    for (day_offset, created_at, task_type, task_name, _), (tasks, elapsed, changed) in zip(requests_to_send, results):
+        prefix = f"   {date_label(day_offset)} ({created_at}) {task_name}:"
+        if tasks is None:
+            log.info("%s 查询失败, 耗时 %.0f ms，下一轮重试", prefix, elapsed * 1000)
+            continue
+        task_lists[(task_type, created_at)] = tasks
+        log.info("%s %s 个, 耗时 %.0f ms%s", prefix, len(tasks), elapsed * 1000, '' if changed else ' (与上次相同)')
 
+    log.info("   共 %s 个列表并发获取, 总耗时 %.0f ms", len(requests_to_send), wall_time * 1000)
+    return task_lists
 
-# ==================== 日期处理函数 ====================
 
-def get_date_list():
+def merge_task_lists(task_type, task_lists, date_list):
     """
-    获取需要处理的日期列表：今天、昨天、前天
-    返回格式：["2025-11-20", "2025-11-19", "2025-11-18"]
+    按日期从新到旧合并同一类型的任务列表，同一 keer_product_id 只保留最新日期的一条
+
+    返回: (任务列表, 每个任务对应的日期 {keer_product_id: created_at}, 去掉的重复数量)
     """
-    today = datetime.now()
-    date_list = []
+    merged = []
+    task_dates = {}
+    duplicates = 0
+    for created_at in date_list:
+        for task in task_lists.get((task_type, created_at), []):
+            key = str(task.get('keer_product_id'))
+            if key in task_dates:
+                duplicates += 1
+                continue
+            task_dates[key] = created_at
+            merged.append(task)
+    return merged, task_dates, duplicates
 
-    for i in range(3):  # 今天、昨天、前天
-        date = today - timedelta(days=i)
-        date_str = date.strftime("%Y-%m-%d")
-        date_list.append(date_str)
 
-    return date_list
+def next_poll_interval(previous_interval, new_tasks):
+    """
+    计算下一轮开始前的等待时间
+
+    - 有新任务: POLL_BUSY_INTERVAL（快速轮询）
+    - 没有新任务（没有任务，或只有已尝试过的任务）: 从 LOOP_INTERVAL 开始
+      按 POLL_BACKOFF_FACTOR 倍数退避，最多 POLL_MAX_INTERVAL
+    """
+    if new_tasks > 0:
+        return POLL_BUSY_INTERVAL
+
+    if previous_interval < LOOP_INTERVAL:
+        return min(LOOP_INTERVAL, POLL_MAX_INTERVAL)
+
+    return min(previous_interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
 
 
 # ==================== 内部API函数 ====================
@@ -121,21 +1536,17 @@ def get_internal_tasks(store_code, created_at):
     """
     获取内部待报价任务
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         "store_code": store_code,
         "created_at": created_at
     }
 
     try:
-        response = requests.post(INTERNAL_API_URL, headers=headers, json=payload, timeout=30)
+        response = get_internal_session().post(INTERNAL_API_URL, **json_request(payload), timeout=30)
         response.raise_for_status()
-        return response.json()
+        return json_response(response)
     except Exception as e:
-        print(f"获取内部任务失败: {e}")
+        log.error("获取内部任务失败: %s", e)
         return None
 
 
@@ -143,21 +1554,17 @@ def get_non_quotable_tasks(store_code, created_at):
     """
     获取标记不可报价任务
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         "store_code": store_code,
         "created_at": created_at
     }
 
     try:
-        response = requests.post(INTERNAL_NON_QUOTABLE_URL, headers=headers, json=payload, timeout=30)
+        response = get_internal_session().post(INTERNAL_NON_QUOTABLE_URL, **json_request(payload), timeout=30)
         response.raise_for_status()
-        return response.json()
+        return json_response(response)
     except Exception as e:
-        print(f"获取标记不可报价任务失败: {e}")
+        log.error("获取标记不可报价任务失败: %s", e)
         return None
 
 
@@ -172,26 +1579,22 @@ def get_product_id_by_keer_id(keer_product_id):
         成功: (product_id, supplier_name) - 元组
         失败: (None, None)
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         "keep_product_id": int(keer_product_id)
     }
 
     try:
-        print(f"\n🔍 调用sp_productid接口...")
-        print(f"   URL: {GET_SP_PRODUCT_ID_URL}")
-        print(f"   参数: {json.dumps(payload, ensure_ascii=False)}")
+        log.info("🔍 调用sp_productid接口...")
+        log.debug("   URL: %s", GET_SP_PRODUCT_ID_URL)
+        log.debug("   参数: %s", LazyJson(payload))
 
-        response = requests.post(GET_SP_PRODUCT_ID_URL, headers=headers, json=payload, timeout=30)
+        response = get_internal_session().post(GET_SP_PRODUCT_ID_URL, **json_request(payload), timeout=30)
 
-        print(f"   📥 响应状态: {response.status_code}")
-        print(f"   📥 响应内容: {response.text}")
+        log.debug("   📥 响应状态: %s", response.status_code)
+        log.debug("   📥 响应内容: %s", LogTruncated(response.text))
 
         if response.status_code == 200:
-            result = response.json()
+            result = json_response(response)
 
             if result.get('success') and result.get('data'):
                 data_list = result['data']
@@ -199,26 +1602,44 @@ def get_product_id_by_keer_id(keer_product_id):
                     product_id = data_list[0].get('product_id')
                     supplier_name = data_list[0].get('supplier_name')
 
-                    print(f"   ✅ 获取成功!")
-                    print(f"      product_id: {product_id}")
-                    print(f"      supplier_name: {supplier_name}")
+                    log.info("   ✅ 获取成功!")
+                    log.info("      product_id: %s", product_id)
+                    log.info("      supplier_name: %s", supplier_name)
 
                     return (product_id, supplier_name)
                 else:
-                    print(f"   ⚠️  返回数据为空")
+                    log.warning("   ⚠️  返回数据为空")
                     return (None, None)
             else:
-                print(f"   ⚠️  接口返回失败: {result}")
+                log.warning("   ⚠️  接口返回失败: %s", result)
                 return (None, None)
         else:
-            print(f"   ⚠️  HTTP状态码错误: {response.status_code}")
+            log.warning("   ⚠️  HTTP状态码错误: %s", response.status_code)
             return (None, None)
 
     except Exception as e:
-        print(f"   ❌ 调用sp_productid接口异常: {e}")
+        log.error("   ❌ 调用sp_productid接口异常: %s", e)
         return (None, None)
 
 
+def lookup_keer_mapping(keer_product_id):
+    """
+    获取SP产品ID和供应商名称：优先本地映射，未命中再调用sp_productid接口并保存
+
+    返回:
+        (product_id, supplier_name, from_store)，失败时为 (None, None, False)
+    """
+    product_id, supplier_name = get_keer_mapping(keer_product_id)
+    if product_id and supplier_name:
+        log.info("   ♻️  命中本地产品映射: product_id=%s, supplier_name=%s", product_id, supplier_name)
+        return (product_id, supplier_name, True)
+
+    product_id, supplier_name = get_product_id_by_keer_id(keer_product_id)
+    if product_id and supplier_name:
+        save_keer_mapping(keer_product_id, product_id, supplier_name)
+    return (product_id, supplier_name, False)
+
+
 def save_task_status(keer_product_id, sp_status=None, quotation_feedback_status=None, shi_image_note=None):
     """
     保存任务状态到内部系统
@@ -229,10 +1650,6 @@ def save_task_status(keer_product_id, sp_status=None, quotation_feedback_status=
     3 = 价格成功消息失败(报价成功 + 消息失败)
     4 = 价格失败消息成功(报价失败 + 消息成功)
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         "keer_product_id": str(keer_product_id)
     }
@@ -245,12 +1662,12 @@ def save_task_status(keer_product_id, sp_status=None, quotation_feedback_status=
         payload["shi_image_note"] = shi_image_note
 
     try:
-        response = requests.post(SAVE_TASK_URL, headers=headers, json=payload, timeout=30)
-        print(f"📝 保存任务状态: {response.status_code}")
-        print(f"   响应: {response.text}")
+        response = get_internal_session().post(SAVE_TASK_URL, **json_request(payload), timeout=30)
+        log.debug("📝 保存任务状态: %s", response.status_code)
+        log.debug("   响应: %s", LogTruncated(response.text))
         return response.status_code == 200
     except Exception as e:
-        print(f"❌ 保存任务状态失败: {e}")
+        log.error("❌ 保存任务状态失败: %s", e)
         return False
 
 
@@ -264,37 +1681,136 @@ def update_sp_status(keer_product_id):
     返回:
         bool: 更新成功返回True，失败返回False
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
     payload = {
         "id": int(keer_product_id),
         "sp_status": 2  # 固定值2
     }
 
     try:
-        print(f"\n🔄 调用update_sp_status接口...")
-        print(f"   URL: {UPDATE_SP_STATUS_URL}")
-        print(f"   参数: {json.dumps(payload, ensure_ascii=False)}")
+        log.info("🔄 调用update_sp_status接口...")
+        log.debug("   URL: %s", UPDATE_SP_STATUS_URL)
+        log.debug("   参数: %s", LazyJson(payload))
 
-        response = requests.post(UPDATE_SP_STATUS_URL, headers=headers, json=payload, timeout=30)
+        response = get_internal_session().post(UPDATE_SP_STATUS_URL, **json_request(payload), timeout=30)
 
-        print(f"   📥 响应状态: {response.status_code}")
-        print(f"   📥 响应内容: {response.text}")
+        log.debug("   📥 响应状态: %s", response.status_code)
+        log.debug("   📥 响应内容: %s", LogTruncated(response.text))
 
         if response.status_code == 200:
-            print(f"   ✅ SP状态更新成功!")
+            log.info("   ✅ SP状态更新成功!")
             return True
         else:
-            print(f"   ⚠️  SP状态更新失败: HTTP {response.status_code}")
+            log.warning("   ⚠️  SP状态更新失败: HTTP %s", response.status_code)
             return False
 
     except Exception as e:
-        print(f"   ❌ SP状态更新异常: {e}")
+        log.error("   ❌ SP状态更新异常: %s", e)
         return False
 
 
+def save_task_status_bulk(payloads):
+    """
+    批量保存任务状态
+
+    内部系统暂未提供批量接口，这里逐条调用 save_task_status 作为本地替代；
+    有批量接口后只需替换本函数
+
+    返回: 与payloads顺序一致的结果列表 [True/False, ...]
+    """
+    return [save_task_status(**payload) for payload in payloads]
+
+
+def update_sp_status_bulk(keer_product_ids):
+    """
+    批量更新SP状态为已完成（本地替代实现，逐条调用 update_sp_status）
+
+    返回: 与keer_product_ids顺序一致的结果列表 [True/False, ...]
+    """
+    return [update_sp_status(keer_product_id) for keer_product_id in keer_product_ids]
+
+
+class TaskStatus:
+    """
+    单个任务的状态累加器
+
+    处理过程中的多次 save_task_status / update_sp_status 先记录在这里，
+    任务结束时由 flush_task_statuses 合并为一次回写（同一字段后写覆盖先写）
+    """
+
+    def __init__(self, keer_product_id):
+        self.keer_product_id = keer_product_id
+        self.fields = {}
+        self.sp_completed = False
+
+    def save(self, sp_status=None, quotation_feedback_status=None, shi_image_note=None):
+        """
+        记录待保存的状态字段，参数含义同 save_task_status
+
+        返回: True（实际结果在回写时输出）
+        """
+        updates = {
+            "sp_status": sp_status,
+            "quotation_feedback_status": quotation_feedback_status,
+            "shi_image_note": shi_image_note
+        }
+        self.fields.update({key: value for key, value in updates.items() if value is not None})
+        return True
+
+    def mark_sp_completed(self):
+        """
+        记录需要调用 update_sp_status 接口
+        """
+        self.sp_completed = True
+
+    def payload(self):
+        """
+        合并后的 save_task_status 参数，没有待保存字段返回 None
+        """
+        if not self.keer_product_id or not self.fields:
+            return None
+        return {"keer_product_id": self.keer_product_id, **self.fields}
+
+
+def flush_task_statuses(statuses):
+    """
+    把一批任务状态写入回写队列：每个任务先合并保存任务状态，再更新SP状态（与原先逐次调用的顺序一致）
+    实际的内部API调用由 STATUS_OUTBOX 后台线程完成
+    """
+    entries = []
+    for status in statuses:
+        payload = status.payload()
+        if payload:
+            entries.append((status.keer_product_id, StatusOutbox.KIND_SAVE, payload))
+        if status.sp_completed and status.keer_product_id:
+            entries.append((status.keer_product_id, StatusOutbox.KIND_SP_COMPLETED, {}))
+
+    try:
+        STATUS_OUTBOX.enqueue(entries)
+    except sqlite3.Error as e:
+        # 本地数据库不可用时退回直接回写，避免状态丢失
+        log.warning("⚠️  写入状态回写队列失败: %s，直接回写", e)
+        save_task_status_bulk([payload for _, kind, payload in entries if kind == StatusOutbox.KIND_SAVE])
+        update_sp_status_bulk([keer_id for keer_id, kind, _ in entries if kind == StatusOutbox.KIND_SP_COMPLETED])
+
+
+def run_task_with_status(process_func, task_data, label=None):
+    """
+    执行任务，任务内的状态写入在结束时合并回写（任务异常时已记录的状态同样回写）
+    结束时输出一行任务汇总
+    """
+    status = TaskStatus(task_data.get('keer_product_id'))
+    set_log_task(label)
+    started = time.perf_counter()
+    success = False
+    try:
+        success = process_func(task_data, status)
+        return success
+    finally:
+        flush_task_statuses([status])
+        log_task_summary(task_data, status, success, time.perf_counter() - started)
+        set_log_task(None)
+
+
 def get_message_content(keer_product_id):
     """
     获取消息内容
@@ -309,24 +1825,24 @@ def get_message_content(keer_product_id):
     data = parse.urlencode(form_data, True)
 
     try:
-        response = requests.post(GET_MESSAGE_URL, headers=headers, data=data, timeout=30)
+        response = get_internal_session().post(GET_MESSAGE_URL, headers=headers, data=data, timeout=30)
         response.raise_for_status()
-        result = response.json()
+        result = json_response(response)
 
         if result.get('success') and result.get('data'):
             message = result['data'][0].get('product_attribute', '').strip()
             if message:
-                print(f"   ✅ 获取到自定义消息（长度: {len(message)}）")
+                log.info("   ✅ 获取到自定义消息（长度: %s）", len(message))
                 return message
             else:
-                print(f"   ℹ️  消息为空，使用默认消息")
+                log.info("   ℹ️  消息为空，使用默认消息")
                 return DEFAULT_MESSAGE
         else:
-            print(f"   ⚠️  获取消息失败，使用默认消息")
+            log.warning("   ⚠️  获取消息失败，使用默认消息")
             return DEFAULT_MESSAGE
 
     except Exception as e:
-        print(f"   ❌ 获取消息异常: {e}，使用默认消息")
+        log.error("   ❌ 获取消息异常: %s，使用默认消息", e)
         return DEFAULT_MESSAGE
 
 
@@ -334,232 +1850,600 @@ def get_uploaded_images(keer_product_id):
     """
     获取已上传的图片记录
     """
-    headers = {
-        'Content-Type': 'application/json'
+    payload = {
+        "keer_product_id": str(keer_product_id)
     }
 
+    try:
+        response = get_internal_session().post(GET_TASK_DETAIL_URL, **json_request(payload), timeout=30)
+        response.raise_for_status()
+        result = json_response(response)
+
+        if result.get('success') and result.get('data'):
+            shi_image_note = result['data'][0].get('shi_image_note', '')
+            if shi_image_note and shi_image_note != 'null':
+                return shi_image_note.strip()
+        return ''
+
+    except Exception as e:
+        log.error("   ❌ 获取已上传图片记录失败: %s", e)
+        return ''
+
+
+def get_all_product_images(keer_product_id):
+    """
+    获取所有产品实拍图
+    """
     payload = {
-        "keer_product_id": str(keer_product_id)
+        "id": str(keer_product_id)
+    }
+
+    try:
+        response = get_internal_session().post(GET_PRODUCT_INFO_URL, **json_request(payload), timeout=30)
+        response.raise_for_status()
+        result = json_response(response)
+
+        if result.get('success') and result.get('data'):
+            product_shi_img = result['data'][0].get('product_shi_img', '')
+            if product_shi_img and product_shi_img != 'null':
+                return product_shi_img.strip()
+        return ''
+
+    except Exception as e:
+        log.error("   ❌ 获取产品实拍图失败: %s", e)
+        return ''
+
+
+def calculate_new_images(all_images_str, uploaded_images_str):
+    """
+    计算待上传的新图片
+    """
+    if not all_images_str:
+        return []
+
+    # 支持中英文逗号分割
+    all_images_str = all_images_str.replace('，', ',')
+    all_images = [img.strip() for img in all_images_str.split(',') if img.strip()]
+
+    if not uploaded_images_str:
+        return all_images
+
+    # 支持中英文逗号分割
+    uploaded_images_str = uploaded_images_str.replace('，', ',')
+    uploaded_images = [img.strip() for img in uploaded_images_str.split(',') if img.strip()]
+    new_images = [img for img in all_images if img not in uploaded_images]
+
+    return new_images
+
+
+def detect_image_format(data):
+    """
+    通过文件头检测真实图片格式
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    elif data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    elif data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+        return 'GIF'
+    elif data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'WEBP'
+    elif b'ftypavif' in data[:20] or b'ftypavis' in data[:20]:
+        return 'AVIF'
+    elif data[4:8] == b'ftyp' and data[8:12] in (b'heic', b'heix', b'hevc', b'hevx', b'mif1', b'msf1'):
+        return 'HEIC'
+    elif data.startswith(b'BM'):
+        return 'BMP'
+    else:
+        return 'UNKNOWN'
+
+
+def _save_image(img, output_format, quality=None):
+    """
+    按输出格式编码为字节
+    """
+    output_buffer = BytesIO()
+    if output_format == 'JPEG':
+        img.save(output_buffer, format=output_format, quality=quality, optimize=True)
+    else:
+        img.save(output_buffer, format=output_format, optimize=True)
+    return output_buffer.getvalue()
+
+
+def _encode_jpeg_within_budget(img, max_bytes):
+    """
+    二分查找满足预算的最高JPEG质量
+
+    返回: (编码后字节, 质量)；最低质量仍超预算时返回最低质量的结果
+    """
+    data = _save_image(img, 'JPEG', IMAGE_JPEG_MAX_QUALITY)
+    if max_bytes is None or len(data) <= max_bytes:
+        return data, IMAGE_JPEG_MAX_QUALITY
+
+    best = None
+    low, high = IMAGE_JPEG_MIN_QUALITY, IMAGE_JPEG_MAX_QUALITY - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save_image(img, 'JPEG', quality)
+        if len(candidate) <= max_bytes:
+            best = (candidate, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best:
+        return best
+    return _save_image(img, 'JPEG', IMAGE_JPEG_MIN_QUALITY), IMAGE_JPEG_MIN_QUALITY
+
+
+def _encode_png_within_budget(img, max_bytes):
+    """
+    PNG超出预算时改用256色调色板（保留透明通道），取两者中较小的结果
+    """
+    data = _save_image(img, 'PNG')
+    if max_bytes is None or len(data) <= max_bytes:
+        return data
+
+    quantized = _save_image(img.quantize(colors=256, method=Image.Quantize.FASTOCTREE), 'PNG')
+    return min(data, quantized, key=len)
+
+
+def encode_image(data, max_bytes=None):
+    """
+    使用PIL把任意格式图片转换为上传格式
+    有透明通道 → PNG，否则 → JPEG
+
+    长边超过 IMAGE_MAX_DIMENSION 时先等比缩小；超过 max_bytes 时
+    JPEG二分查找质量，PNG改用调色板（透明通道实际全不透明时改为JPEG），
+    仍不满足则继续缩小尺寸（长边不低于 IMAGE_MIN_DIMENSION）
+
+    返回:
+        {"content": 编码后字节, "format": "PNG"/"JPEG", "ext": "png"/"jpg", "type": MIME类型,
+         "over_budget": 缩小到最小尺寸后仍超过 max_bytes 时为True}
+    """
+    img = Image.open(BytesIO(data))
+
+    # 检查是否有透明通道
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+    # 决定输出格式
+    if has_alpha:
+        output_format = 'PNG'
+        ext = 'png'
+        mime_type = 'image/png'
+
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+    else:
+        output_format = 'JPEG'
+        ext = 'jpg'
+        mime_type = 'image/jpeg'
+
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+    if max(img.size) > IMAGE_MAX_DIMENSION:
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+
+    while True:
+        if output_format == 'JPEG':
+            converted_data, quality = _encode_jpeg_within_budget(img, max_bytes)
+        else:
+            converted_data, quality = _encode_png_within_budget(img, max_bytes), None
+
+        if max_bytes is None or len(converted_data) <= max_bytes:
+            break
+
+        # 透明通道全不透明：改为JPEG，可以降低质量而不是只缩小尺寸
+        if output_format == 'PNG' and img.getchannel('A').getextrema()[0] == 255:
+            output_format = 'JPEG'
+            ext = 'jpg'
+            mime_type = 'image/jpeg'
+            img = img.convert('RGB')
+            continue
+
+        longest = max(img.size)
+        if longest <= IMAGE_MIN_DIMENSION:
+            break
+
+        # 超出预算：按比例缩小后重试
+        target = max(IMAGE_MIN_DIMENSION, int(longest * 0.75))
+        img.thumbnail((target, target), Image.LANCZOS)
+
+    return {
+        "content": converted_data,
+        "format": output_format,
+        "ext": ext,
+        "type": mime_type,
+        "size": img.size,
+        "quality": quality,
+        "over_budget": max_bytes is not None and len(converted_data) > max_bytes
+    }
+
+
+def inspect_image_header(data, detected_format):
+    """
+    只解析文件头获取图片信息（不解码像素）
+
+    返回:
+        {"width", "height", "has_alpha", "components", "has_metadata"}，无法解析时返回None
+        has_alpha 与PIL判断规则一致：PNG带alpha通道(LA/RGBA)或调色板带tRNS
+        has_metadata: 带EXIF/XMP等元数据（拍摄位置、设备、方向等），PIL重新编码时会去掉
+    """
+    try:
+        if detected_format == 'PNG':
+            width, height, bit_depth, color_type = struct.unpack('>IIBB', data[16:26])
+            has_alpha = color_type in (4, 6)
+            has_metadata = False
+
+            # 遍历数据块（只读块头）：调色板透明(tRNS)、动图(acTL)、元数据(eXIf/文本块，XMP在iTXt中)
+            offset = 8
+            while offset + 8 <= len(data):
+                length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+                if chunk_type == b'IEND':
+                    break
+                if chunk_type == b'acTL':
+                    return None
+                if chunk_type == b'tRNS' and color_type == 3:
+                    has_alpha = True
+                if chunk_type in (b'eXIf', b'tEXt', b'zTXt', b'iTXt'):
+                    has_metadata = True
+                offset += 12 + length
+
+            return {"width": width, "height": height, "has_alpha": has_alpha, "components": None,
+                    "has_metadata": has_metadata}
+
+        if detected_format == 'JPEG':
+            offset = 2
+            has_metadata = False
+            while offset + 4 <= len(data):
+                if data[offset] != 0xFF:
+                    return None
+                marker = data[offset + 1]
+                if marker == 0xFF:
+                    offset += 1
+                    continue
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                    offset += 2
+                    continue
+
+                length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+                # APP1: EXIF / XMP；APP13: Photoshop IPTC
+                if marker in (0xE1, 0xED):
+                    has_metadata = True
+                # SOF0-SOF15（排除DHT/JPG/DAC）
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width, components = struct.unpack('>HHB', data[offset + 5:offset + 10])
+                    return {"width": width, "height": height, "has_alpha": False, "components": components,
+                            "has_metadata": has_metadata}
+                if marker == 0xDA:
+                    return None
+                offset += 2 + length
+
+            return None
+    except struct.error:
+        return None
+
+    return None
+
+
+def passthrough_image(data, detected_format, max_bytes=None):
+    """
+    已满足上传要求的图片直接使用原始字节
+
+    条件：
+    - 不带EXIF/XMP等元数据（重新编码会去掉拍摄位置、设备信息，且像素按未旋转的方向发送）
+    - JPEG（灰度或YCbCr，排除CMYK）→ 原本也会输出JPEG
+    - 带透明的PNG → 原本也会输出PNG
+    - 大小不超过 IMAGE_PASSTHROUGH_MAX_BYTES 和体积预算，长边不超过 IMAGE_MAX_DIMENSION
+
+    返回: 与 encode_image 相同结构的结果，不满足条件返回None
+    """
+    size_limit = IMAGE_PASSTHROUGH_MAX_BYTES if max_bytes is None else min(IMAGE_PASSTHROUGH_MAX_BYTES, max_bytes)
+    if not IMAGE_PASSTHROUGH_ENABLED or len(data) > size_limit:
+        return None
+
+    header = inspect_image_header(data, detected_format)
+    if not header or not header['width'] or not header['height'] or header['has_metadata']:
+        return None
+
+    if max(header['width'], header['height']) > IMAGE_MAX_DIMENSION:
+        return None
+
+    if detected_format == 'JPEG' and header['components'] in (1, 3):
+        return {"content": data, "format": 'JPEG', "ext": 'jpg', "type": 'image/jpeg'}
+
+    if detected_format == 'PNG' and header['has_alpha']:
+        return {"content": data, "format": 'PNG', "ext": 'png', "type": 'image/png'}
+
+    return None
+
+
+# 图片处理CPU耗时统计（线程CPU时间），用于对比直通与重新编码
+IMAGE_ENCODE_STATS = {
+    "passthrough": 0,
+    "passthrough_cpu": 0.0,
+    "reencoded": 0,
+    "reencoded_cpu": 0.0
+}
+_image_encode_stats_lock = threading.Lock()
+
+
+def prepare_image(data, detected_format, max_bytes=None):
+    """
+    生成上传用图片：优先直通，否则PIL重新编码，并记录CPU耗时
+    """
+    cpu_start = time.thread_time()
+
+    encoded = passthrough_image(data, detected_format, max_bytes)
+    kind = "passthrough" if encoded else "reencoded"
+    if encoded is None:
+        encoded = encode_image(data, max_bytes)
+
+    cpu_used = time.thread_time() - cpu_start
+    with _image_encode_stats_lock:
+        IMAGE_ENCODE_STATS[kind] += 1
+        IMAGE_ENCODE_STATS[f"{kind}_cpu"] += cpu_used
+
+    encoded['passthrough'] = kind == "passthrough"
+    return encoded
+
+
+def print_image_encode_stats():
+    """
+    输出图片处理CPU耗时统计
+    """
+    with _image_encode_stats_lock:
+        stats = dict(IMAGE_ENCODE_STATS)
+
+    if not stats['passthrough'] and not stats['reencoded']:
+        return
+
+    log.info("🖼️  图片处理CPU耗时 (累计):")
+    for kind, label in (("passthrough", "直通"), ("reencoded", "PIL重新编码")):
+        count = stats[kind]
+        cpu = stats[f"{kind}_cpu"]
+        average = cpu / count * 1000 if count else 0
+        log.info("   %s: %s 张, 共 %.3fs, 平均 %.1f ms/张", label, count, cpu, average)
+
+
+def build_image_file(encoded, index):
+    """
+    把编码结果组装为 myProductfiles 中的单个文件
+    content保留原始字节，发送时再流式base64编码（见 write_message_body）
+    """
+    return {
+        "name": f"image{index}.{encoded['ext']}",
+        "content": encoded['content'],
+        "type": encoded['type']
     }
 
-    try:
-        response = requests.post(GET_TASK_DETAIL_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        result = response.json()
 
-        if result.get('success') and result.get('data'):
-            shi_image_note = result['data'][0].get('shi_image_note', '')
-            if shi_image_note and shi_image_note != 'null':
-                return shi_image_note.strip()
-        return ''
+# AVIF/HEIC图片的URL转换方式（按顺序尝试）
+# - jpg_suffix: 1688/alicdn 地址 xxx_!!yyy → xxx.jpg_!!yyy
+# - oss_format: 阿里云OSS图片处理参数 x-oss-process=image/format,jpg
+IMAGE_URL_REWRITES = ('jpg_suffix', 'oss_format')
 
-    except Exception as e:
-        print(f"   ❌ 获取已上传图片记录失败: {e}")
-        return ''
+# 每个CDN host转换成功的方式：后续同host的AVIF/HEIC图片优先使用
+_image_rewrite_memo = {}
+_image_rewrite_memo_lock = threading.Lock()
 
 
-def get_all_product_images(keer_product_id):
+def rewrite_image_url(image_url, method):
     """
-    获取所有产品实拍图
+    按指定方式生成转换后的图片URL，该方式不适用时返回None
     """
-    headers = {
-        'Content-Type': 'application/json'
-    }
+    if method == 'jpg_suffix':
+        return image_url.replace('_!!', '.jpg_!!') if '_!!' in image_url else None
 
-    payload = {
-        "id": str(keer_product_id)
-    }
+    if method == 'oss_format':
+        if '?' in image_url:
+            return f"{image_url}&x-oss-process=image/format,jpg"
+        return f"{image_url}?x-oss-process=image/format,jpg"
 
-    try:
-        response = requests.post(GET_PRODUCT_INFO_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        result = response.json()
+    return None
 
-        if result.get('success') and result.get('data'):
-            product_shi_img = result['data'][0].get('product_shi_img', '')
-            if product_shi_img and product_shi_img != 'null':
-                return product_shi_img.strip()
-        return ''
 
-    except Exception as e:
-        print(f"   ❌ 获取产品实拍图失败: {e}")
-        return ''
+def url_declares_avif(image_url):
+    """
+    URL路径的扩展名表明是AVIF/HEIC图片（如 xxx.jpg_.avif）
+    """
+    return parse.urlsplit(image_url).path.lower().endswith(('.avif', '.heic', '.heif'))
 
 
-def calculate_new_images(all_images_str, uploaded_images_str):
+def fetch_with_remembered_rewrite(image_url):
     """
-    计算待上传的新图片
+    host已记录可用的转换方式时，直接下载转换后的URL
+    只用于URL已表明是AVIF/HEIC的图片（见 url_declares_avif），其他图片先下载原地址，
+    避免JPEG/PNG/GIF也被服务端转成JPEG（丢失透明、多一次有损压缩）
+
+    返回:
+        (response, detected_format)，未记录或转换地址不可用时返回 (None, None)
     """
-    if not all_images_str:
-        return []
+    host = get_image_host(image_url)
+    with _image_rewrite_memo_lock:
+        method = _image_rewrite_memo.get(host)
 
-    # 支持中英文逗号分割
-    all_images_str = all_images_str.replace('，', ',')
-    all_images = [img.strip() for img in all_images_str.split(',') if img.strip()]
+    converted_url = rewrite_image_url(image_url, method) if method else None
+    if not converted_url:
+        return None, None
 
-    if not uploaded_images_str:
-        return all_images
+    try:
+        response = fetch_image(converted_url)
+        response.raise_for_status()
+        detected_format = detect_image_format(response.content)
+    except requests.exceptions.RequestException as e:
+        log.warning("      ⚠️  已记录的转换地址下载失败，改用原地址: %s", e)
+        return None, None
 
-    # 支持中英文逗号分割
-    uploaded_images_str = uploaded_images_str.replace('，', ',')
-    uploaded_images = [img.strip() for img in uploaded_images_str.split(',') if img.strip()]
-    new_images = [img for img in all_images if img not in uploaded_images]
+    if detected_format in ('AVIF', 'HEIC', 'UNKNOWN'):
+        log.warning("      ⚠️  已记录的转换方式 %s 返回 %s，改用原地址", method, detected_format)
+        with _image_rewrite_memo_lock:
+            if _image_rewrite_memo.get(host) == method:
+                del _image_rewrite_memo[host]
+        return None, None
 
-    return new_images
+    log.info("      🔗 使用%s已记录的转换方式 %s (格式: %s)", host, method, detected_format)
+    return response, detected_format
 
 
-def download_and_encode_image(image_url, index, max_retries=3):
+def convert_image_by_url(image_url):
     """
-    下载图片并转换为base64（支持所有格式包括AVIF）
+    通过URL转换获取非AVIF/HEIC格式的图片，成功后记录该host的转换方式
 
-    支持的输入格式：PNG, JPG, GIF, WEBP, AVIF, BMP等
-    输出格式：PNG（透明）或 JPG（不透明）
+    返回:
+        (response, detected_format, retryable)
+        全部失败时response为None；retryable表示失败中是否有网络异常（值得整体重试）
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-        'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-        'Accept-Encoding': 'gzip, deflate',
-        'Referer': 'https://www.1688.com/',
-        'Connection': 'keep-alive',
-    }
-
-    def detect_image_format(data):
-        """
-        通过文件头检测真实图片格式
-        """
-        if data.startswith(b'\x89PNG\r\n\x1a\n'):
-            return 'PNG'
-        elif data.startswith(b'\xff\xd8\xff'):
-            return 'JPEG'
-        elif data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
-            return 'GIF'
-        elif data.startswith(b'RIFF') and data[8:12] == b'WEBP':
-            return 'WEBP'
-        elif b'ftypavif' in data[:20] or b'ftypavis' in data[:20]:
-            return 'AVIF'
-        elif data.startswith(b'BM'):
-            return 'BMP'
-        else:
-            return 'UNKNOWN'
+    host = get_image_host(image_url)
+    with _image_rewrite_memo_lock:
+        remembered = _image_rewrite_memo.get(host)
+
+    methods = list(IMAGE_URL_REWRITES)
+    if remembered in methods:
+        methods.remove(remembered)
+        methods.insert(0, remembered)
+
+    retryable = False
+    for method in methods:
+        converted_url = rewrite_image_url(image_url, method)
+        if not converted_url:
+            continue
 
-    for attempt in range(1, max_retries + 1):
         try:
-            print(f"      下载图片 {index} (尝试 {attempt}/{max_retries}): {image_url[:60]}...")
+            log.debug("      🔗 尝试转换URL: %s...", converted_url[:80])
 
-            response = requests.get(
-                image_url,
-                headers=headers,
-                timeout=30,
-                allow_redirects=True
-            )
-            response.raise_for_status()
+            conv_response = fetch_image(converted_url)
+            conv_response.raise_for_status()
 
-            # 检测真实图片格式
-            detected_format = detect_image_format(response.content)
-            print(f"      🔍 检测到格式: {detected_format}")
+            conv_format = detect_image_format(conv_response.content)
+            log.debug("      📋 转换后格式: %s", conv_format)
 
-            # 如果检测到AVIF格式，尝试URL转换
-            if detected_format == 'AVIF':
-                print(f"      🔄 检测到AVIF格式，尝试URL转换...")
+            if conv_format not in ('AVIF', 'HEIC'):
+                log.info("      ✅ 转换成功: → %s (记录 %s 使用 %s)", conv_format, host, method)
+                with _image_rewrite_memo_lock:
+                    _image_rewrite_memo[host] = method
+                return conv_response, conv_format, False
 
-                # 尝试多种URL转换方式
-                conversion_methods = []
+        except Exception as conv_error:
+            log.warning("      ⚠️  转换失败: %s", conv_error)
+            retryable = True
+            continue
 
-                if '_!!' in image_url:
-                    conversion_methods.append(image_url.replace('_!!', '.jpg_!!'))
+    return None, None, retryable
 
-                if '?' in image_url:
-                    conversion_methods.append(f"{image_url}&x-oss-process=image/format,jpg")
-                else:
-                    conversion_methods.append(f"{image_url}?x-oss-process=image/format,jpg")
 
-                converted_successfully = False
+def compute_image_budget(image_count):
+    """
+    单张图片的体积预算：不超过 IMAGE_MAX_BYTES，且所有图片合计不超过 MESSAGE_MAX_IMAGE_BYTES
+    """
+    if image_count <= 0:
+        return IMAGE_MAX_BYTES
+    return min(IMAGE_MAX_BYTES, MESSAGE_MAX_IMAGE_BYTES // image_count)
 
-                for converted_url in conversion_methods:
-                    try:
-                        print(f"      🔗 尝试转换URL: {converted_url[:80]}...")
-
-                        conv_response = requests.get(
-                            converted_url,
-                            headers=headers,
-                            timeout=30,
-                            allow_redirects=True
-                        )
-                        conv_response.raise_for_status()
-
-                        conv_format = detect_image_format(conv_response.content)
-                        print(f"      📋 转换后格式: {conv_format}")
-
-                        if conv_format != 'AVIF':
-                            print(f"      ✅ 转换成功: AVIF → {conv_format}")
-                            response = conv_response
-                            detected_format = conv_format
-                            converted_successfully = True
-                            break
-
-                    except Exception as conv_error:
-                        print(f"      ⚠️  转换失败: {conv_error}")
-                        continue
-
-                if not converted_successfully:
-                    print(f"      ❌ 所有转换方式都失败")
-                    if attempt < max_retries:
-                        time.sleep(2 * attempt)
-                        continue
-                    return None
 
-            # 使用PIL打开图片
-            try:
-                img = Image.open(BytesIO(response.content))
+def download_and_encode_image(image_url, index, max_retries=3, max_bytes=None):
+    """
+    下载图片并转换为上传格式（支持所有格式包括AVIF）
 
-                # 检查是否有透明通道
-                has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    支持的输入格式：PNG, JPG, GIF, WEBP, AVIF, HEIC, BMP等
+    输出格式：PNG（透明）或 JPG（不透明）
 
-                # 决定输出格式
-                if has_alpha:
-                    output_format = 'PNG'
-                    ext = 'png'
-                    mime_type = 'image/png'
+    max_bytes: 编码后的体积预算（None表示不限制，仍会限制最大尺寸）
 
-                    if img.mode != 'RGBA':
-                        img = img.convert('RGBA')
-                else:
-                    output_format = 'JPEG'
-                    ext = 'jpg'
-                    mime_type = 'image/jpeg'
+    编码结果会写入磁盘缓存：同一URL或同一图片内容再次上传时不再下载/转码
+    """
+    cached = IMAGE_CACHE.get_by_url(image_url)
+    if cached and (max_bytes is None or len(cached['content']) <= max_bytes):
+        log.info("      ♻️  图片 %s 命中URL缓存 (格式: %s, 大小: %s bytes)", index, cached['format'], len(cached['content']))
+        return build_image_file(cached, index)
 
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
+    # 本地解码器处理失败的格式（如AVIF动图/图像序列），之后的尝试改用URL转换
+    local_decode_failed = None
 
-                # 保存到内存
-                output_buffer = BytesIO()
-                if output_format == 'JPEG':
-                    img.save(output_buffer, format=output_format, quality=95, optimize=True)
-                else:
-                    img.save(output_buffer, format=output_format, optimize=True)
+    for attempt in range(1, max_retries + 1):
+        try:
+            log.debug("      下载图片 %s (尝试 %s/%s): %s...", index, attempt, max_retries, image_url[:60])
 
-                output_buffer.seek(0)
-                converted_data = output_buffer.read()
+            response = None
+            detected_format = None
 
-                # 转换为base64
-                image_base64 = base64.b64encode(converted_data).decode('utf-8')
+            if local_decode_failed:
+                # 已知原图本地无法解码：不再下载原图，直接走URL转换
+                detected_format = local_decode_failed
+            else:
+                # URL表明是AVIF且该CDN之前需要URL转换才能拿到非AVIF图片：直接请求转换后的地址
+                # 其他图片下载原地址，检测到AVIF时 convert_image_by_url 会先尝试已记录的方式
+                if 'AVIF' not in LOCAL_DECODE_FORMATS and url_declares_avif(image_url):
+                    response, detected_format = fetch_with_remembered_rewrite(image_url)
+
+                if response is None:
+                    response = fetch_image(image_url)
+                    response.raise_for_status()
+
+                    # 检测真实图片格式
+                    detected_format = detect_image_format(response.content)
+                    log.debug("      🔍 检测到格式: %s", detected_format)
+
+            # AVIF/HEIC：有本地解码器则直接交给PIL，否则（或本地解码失败过）尝试URL转换
+            if detected_format in ('AVIF', 'HEIC'):
+                if detected_format in LOCAL_DECODE_FORMATS and not local_decode_failed:
+                    log.debug("      🧩 使用本地解码器处理%s", detected_format)
+                else:
+                    log.debug("      🔄 检测到%s格式，尝试URL转换...", detected_format)
+                    converted_response, converted_format, retryable = convert_image_by_url(image_url)
+
+                    if converted_response is None:
+                        log.error("      ❌ 所有转换方式都失败")
+                        # 转换地址都能正常访问但仍返回AVIF时，重试也不会成功
+                        if retryable and attempt < max_retries:
+                            time.sleep(2 * attempt)
+                            continue
+                        return None
+
+                    response = converted_response
+                    detected_format = converted_format
+
+            # 相同内容的图片（不同URL）已编码过，直接复用
+            content_key = image_content_key(response.content, max_bytes)
+            cached = IMAGE_CACHE.get(content_key)
+            if cached:
+                IMAGE_CACHE.link_url(image_url, content_key)
+                log.info("      ♻️  图片 %s 命中内容缓存 (格式: %s, 大小: %s bytes)",
+                         index, cached['format'], len(cached['content']))
+                return build_image_file(cached, index)
+
+            # 直通或使用PIL转换图片
+            try:
+                encoded = prepare_image(response.content, detected_format, max_bytes)
 
-                filename = f"image{index}.{ext}"
+                if encoded['passthrough']:
+                    log.debug("      ⏩ 直通原图，跳过重新编码")
+                elif detected_format != encoded['format']:
+                    log.debug("      🔄 已转换: %s → %s", detected_format, encoded['format'])
 
-                if detected_format != output_format:
-                    print(f"      🔄 已转换: {detected_format} → {output_format}")
+                if not encoded['passthrough'] and len(encoded['content']) < len(response.content):
+                    log.debug("      📐 压缩: %s → %s bytes (尺寸: %sx%s, 质量: %s)",
+                              len(response.content), len(encoded['content']),
+                              encoded['size'][0], encoded['size'][1], encoded['quality'] or '-')
 
-                print(f"      ✅ 图片 {index} 处理成功 (格式: {output_format}, 大小: {len(converted_data)} bytes)")
+                log.info("      ✅ 图片 %s 处理成功 (格式: %s, 大小: %s bytes)", index, encoded['format'], len(encoded['content']))
+                if encoded.get('over_budget'):
+                    # 已是最小尺寸，仍上传（消息总大小可能超过 MESSAGE_MAX_IMAGE_BYTES）
+                    log.warning("      ⚠️  图片 %s 缩小到 %sx%s 后仍超出体积预算: %s > %s bytes",
+                                index, encoded['size'][0], encoded['size'][1], len(encoded['content']), max_bytes)
 
-                return {
-                    "name": filename,
-                    "data": image_base64,
-                    "type": mime_type
-                }
+                IMAGE_CACHE.put(image_url, content_key, encoded)
+                return build_image_file(encoded, index)
 
             except Exception as pil_error:
-                print(f"      ❌ PIL处理失败: {pil_error}")
+                log.error("      ❌ PIL处理失败: %s", pil_error)
+
+                # 本地解码器无法处理该文件：重试同样会失败，改用URL转换
+                if detected_format in ('AVIF', 'HEIC') and not local_decode_failed and attempt < max_retries:
+                    log.warning("      🔄 本地解码%s失败，改用URL转换...", detected_format)
+                    local_decode_failed = detected_format
+                    continue
 
                 if attempt < max_retries:
                     time.sleep(2 * attempt)
@@ -567,16 +2451,16 @@ def download_and_encode_image(image_url, index, max_retries=3):
                 return None
 
         except requests.exceptions.RequestException as e:
-            print(f"      ⚠️  下载尝试 {attempt} 失败: {e}")
+            log.warning("      ⚠️  下载尝试 %s 失败: %s", attempt, e)
             if attempt < max_retries:
                 wait_time = 2 * attempt
-                print(f"      ⏳ 等待 {wait_time} 秒后重试...")
+                log.info("      ⏳ 等待 %s 秒后重试...", wait_time)
                 time.sleep(wait_time)
             else:
-                print(f"      ❌ 所有下载尝试均失败")
+                log.error("      ❌ 所有下载尝试均失败")
                 return None
         except Exception as e:
-            print(f"      ❌ 处理失败: {e}")
+            log.error("      ❌ 处理失败: %s", e)
             if attempt < max_retries:
                 time.sleep(2 * attempt)
                 continue
@@ -585,9 +2469,42 @@ def download_and_encode_image(image_url, index, max_retries=3):
     return None
 
 
+def download_images_parallel(image_urls):
+    """
+    并行下载并编码多张图片
+
+    参数:
+        image_urls: 图片URL列表（顺序决定 image{index} 文件名）
+
+    返回:
+        与image_urls顺序一致的结果列表，失败的位置为None
+    """
+    if not image_urls:
+        return []
+
+    workers = max(1, min(IMAGE_DOWNLOAD_WORKERS, len(image_urls)))
+    max_bytes = compute_image_budget(len(image_urls))
+    results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(download_and_encode_image, image_url, index, max_bytes=max_bytes)
+            for index, image_url in enumerate(image_urls, 1)
+        ]
+        for index, future in enumerate(futures, 1):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                log.error("      ❌ 图片 %s 处理异常: %s", index, e)
+                results.append(None)
+
+    return results
+
+
+@lru_cache(maxsize=256)
 def normalize_country_code(country_code):
     """
-    标准化国家代码
+    标准化国家代码（结果缓存，同一报价中国家代码大量重复）
     例如: "UK/GB" -> "GB"
     """
     if not country_code:
@@ -600,18 +2517,116 @@ def normalize_country_code(country_code):
     return COUNTRY_CODE_MAPPING.get(country_code, country_code)
 
 
+class CompiledQuotation:
+    """
+    报价结果的一次性编译结果
+
+    一次遍历 quotation_result 得到有效/为0的报价数量、有报价的国家，
+    以及可生成价格参数的报价（按列存放: 国家、数量、价格）
+    """
+
+    def __init__(self, quotation_result):
+        self.valid_count = 0
+        self.zero_count = 0
+        self.countries_with_quotes = set()
+        self.skipped_zero_price = 0
+        self.country_code_conversions = {}
+
+        self.nations = []
+        self.quantities = []
+        self.prices = []
+
+        for quote in quotation_result:
+            original_nation = quote.get('nation')
+            quantity = quote.get('quantity')
+            price = quote.get('price')
+
+            check_price = quote.get('price', 0)
+            if check_price > 0:
+                self.valid_count += 1
+                if original_nation:  # ✅ 只统计价格>0的国家
+                    self.countries_with_quotes.add(normalize_country_code(original_nation))
+            elif check_price == 0:
+                self.zero_count += 1
+
+            if not original_nation or quantity is None or price is None:
+                continue
+
+            if price == 0:
+                self.skipped_zero_price += 1
+                continue
+
+            nation = normalize_country_code(original_nation)
+            if original_nation != nation and original_nation not in self.country_code_conversions:
+                self.country_code_conversions[original_nation] = nation
+
+            self.nations.append(nation)
+            self.quantities.append(quantity)
+            self.prices.append(price)
+
+    def price_params(self, country_mapping, country_variants, preview_limit=15):
+        """
+        生成 pcs_{quantity}_{variant_id}_{country_id} → 报价（原价 × 0.99，保留两位小数）
+
+        每个国家的 variant_id 只整理一次，每条报价对其所有变体批量写入；
+        参数顺序和重复参数的覆盖方式与逐条赋值一致
+
+        返回: (价格参数dict, 写入次数, 未找到country_id的报价数, 前preview_limit个参数 [(参数名, 报价, 原价)])
+        """
+        params = {}
+        params_count = 0
+        skipped_no_country = 0
+        preview = []
+        variant_ids_by_country = {}
+        price_texts = {}
+
+        for nation, quantity, price in zip(self.nations, self.quantities, self.prices):
+            country_id = country_mapping.get(nation)
+            variants = country_variants.get(nation)
+
+            if not country_id or not variants:
+                skipped_no_country += 1
+                continue
+
+            variant_ids = variant_ids_by_country.get(nation)
+            if variant_ids is None:
+                variant_ids = [f"{variant.get('variant_id')}" for variant in variants if variant.get('variant_id')]
+                variant_ids_by_country[nation] = variant_ids
+
+            price_text = price_texts.get(price)
+            if price_text is None:
+                price_text = price_texts[price] = str(round(price * 0.99, 2))
+
+            prefix = f"pcs_{quantity}_"
+            suffix = f"_{country_id}"
+            names = [prefix + variant_id + suffix for variant_id in variant_ids]
+            params.update(zip(names, repeat(price_text)))
+            params_count += len(names)
+
+            if len(preview) < preview_limit:
+                preview.extend((name, price_text, price) for name in names[:preview_limit - len(preview)])
+
+        return params, params_count, skipped_no_country, preview
+
+
 # ==================== Service Points API函数 ====================
 
-def search_products_by_title(api_key, search_keyword, is_quotation_product=2):
+def search_products_by_title(api_key, search_keyword, is_quotation_product=2, use_cache=True):
     """
     根据产品标题搜索产品
+
+    成功的搜索结果按规范化标题缓存 TITLE_SEARCH_CACHE_TTL 秒；
+    结果为空时缓存 TITLE_SEARCH_NEGATIVE_TTL 秒；请求失败不缓存
     """
-    url = f"{SP_BASE_URL}/get-products"
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
+    cache_key = (api_key, normalize_title(search_keyword), is_quotation_product)
+    if use_cache:
+        cached = TITLE_SEARCH_CACHE.get(cache_key)
+        if cached is not None:
+            products = (cached.get('data') or {}).get('products_data') or []
+            log.info("   ♻️  命中标题搜索缓存 (%s 个产品)", len(products))
+            return cached
 
+    url = f"{SP_BASE_URL}/get-products"
     payload = {
         "is_quotation_product": is_quotation_product,
         "product_search_keys": search_keyword,
@@ -619,15 +2634,22 @@ def search_products_by_title(api_key, search_keyword, is_quotation_product=2):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = get_sp_session(api_key).post(url, **json_request(payload), timeout=30)
         response.raise_for_status()
-        return response.json()
+        result = json_response(response)
     except Exception as e:
-        print(f"搜索产品失败: {e}")
+        log.error("搜索产品失败: %s", e)
         return None
 
+    if isinstance(result, dict) and result.get('success'):
+        products = (result.get('data') or {}).get('products_data') or []
+        ttl = TITLE_SEARCH_CACHE_TTL if products else TITLE_SEARCH_NEGATIVE_TTL
+        TITLE_SEARCH_CACHE.set(cache_key, result, ttl)
+
+    return result
 
-def get_product_by_id(api_key, product_id, is_quotation_product=2):
+
+def get_product_by_id(api_key, product_id, is_quotation_product=2, use_cache=True):
     """
     ✅ 新增函数：根据产品ID获取产品信息（使用 get-products 接口）
 
@@ -635,34 +2657,39 @@ def get_product_by_id(api_key, product_id, is_quotation_product=2):
         api_key: API密钥
         product_id: 产品ID
         is_quotation_product: 产品类型（默认2）
+        use_cache: 是否优先使用进程内缓存（False时强制请求SP并刷新缓存）
 
     返回:
         成功: 产品信息字典（包含 supplier_detail）
         失败: None
     """
-    url = f"{SP_BASE_URL}/get-products"
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
+    cache_key = product_cache_key(api_key, product_id, is_quotation_product)
+    if use_cache:
+        cached = PRODUCT_CACHE.get(cache_key)
+        if cached is not None:
+            log.info("   ♻️  命中产品信息缓存: %s", product_id)
+            return cached
 
+    url = f"{SP_BASE_URL}/get-products"
     payload = {
         "productId": int(product_id),
         "is_quotation_product": is_quotation_product
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = get_sp_session(api_key).post(url, **json_request(payload), timeout=30)
         response.raise_for_status()
-        result = response.json()
+        result = json_response(response)
 
         if result.get('success'):
             products = result.get('data', {}).get('products_data', [])
             if products and len(products) > 0:
+                PRODUCT_CACHE.set(cache_key, products[0])
                 return products[0]  # 返回第一个产品
+        PRODUCT_CACHE.invalidate(cache_key)
         return None
     except Exception as e:
-        print(f"   ⚠️  根据产品ID获取产品失败: {e}")
+        log.warning("   ⚠️  根据产品ID获取产品失败: %s", e)
         return None
 
 
@@ -674,11 +2701,6 @@ def mark_product_non_quotable(api_key, product_id, shopify_product_id):
     - (True, message) : 成功
     - (False, message) : 失败
     """
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
-
     # 只使用两种最可能成功的请求格式
     payload_formats = [
         # 格式1
@@ -697,177 +2719,481 @@ def mark_product_non_quotable(api_key, product_id, shopify_product_id):
         }
     ]
 
-    print(f"\n🔍 尝试标记产品不可报价...")
+    log.info("🔍 尝试标记产品不可报价...")
 
     endpoint = f"{SP_BASE_URL}/mark-product-non-quotable"
 
     # 尝试每种格式
     for idx, payload in enumerate(payload_formats, 1):
         try:
-            print(f"\n   📡 尝试请求格式 #{idx}")
+            log.info("   📡 尝试请求格式 #%s", idx)
 
-            response = requests.post(
+            response = get_sp_session(api_key).post(
                 endpoint,
-                headers=headers,
-                json=payload,
+                **json_request(payload),
                 timeout=30
             )
 
-            print(f"   📥 响应状态: {response.status_code}")
+            log.debug("   📥 响应状态: %s", response.status_code)
 
             # 如果不是404或405，说明endpoint存在
             if response.status_code not in [404, 405]:
                 try:
-                    result = response.json()
-                    print(f"   📥 响应内容: {json.dumps(result, ensure_ascii=False)}")
+                    result = json_response(response)
+                    log.debug("   📥 响应内容: %s", LazyJson(result))
 
                     if result.get('success'):
-                        print(f"   ✅ 标记成功!")
+                        log.info("   ✅ 标记成功!")
                         return (True, "标记成功")
                     else:
                         error_message = result.get('message', '未知错误')
-                        print(f"   ⚠️  API返回: {error_message}")
+                        log.warning("   ⚠️  API返回: %s", error_message)
 
                         # 特殊处理：产品已报价的情况
                         if "Quotation already given" in error_message:
-                            print(f"   ℹ️  产品已有报价，无法标记为不可报价")
+                            log.info("   ℹ️  产品已有报价，无法标记为不可报价")
                             return (False, "产品已报价，无法标记不可报价")
 
-                except json.JSONDecodeError:
-                    print(f"   ⚠️  响应不是有效的JSON")
-                    continue
+                except json.JSONDecodeError:
+                    log.warning("   ⚠️  响应不是有效的JSON")
+                    continue
+
+        except Exception as e:
+            log.warning("   ⚠️  请求失败: %s", e)
+            continue
+
+    log.error("   ❌ 所有尝试均失败")
+    return (False, "所有API调用均失败")
+
+
+def get_supplier_name(product):
+    """
+    产品的报价人员（供应商）名称，supplier_detail 不是字典时返回None
+    """
+    supplier_detail = product.get('supplier_detail', {})
+    if isinstance(supplier_detail, dict):
+        return supplier_detail.get('name', '')
+    return None
+
+
+def resolve_product_by_keer_id(keer_product_id):
+    """
+    方案A：通过Keer产品ID定位SP产品（跳过店铺匹配）
+
+    优先使用本地映射；本地映射指向的产品在SP上不存在或供应商不一致时，
+    作废该映射并重新调用sp_productid接口确认
+
+    返回:
+        成功: (product_id, product_detail, sp_status_message)
+        失败: (None, None, None) - 调用方降级到标题搜索
+    """
+    sp_product_id, expected_supplier_name, from_store = lookup_keer_mapping(keer_product_id)
+    if not sp_product_id or not expected_supplier_name:
+        return (None, None, None)
+
+    log.info("✅ 使用%s获取的产品ID: %s", '本地映射' if from_store else '新接口', sp_product_id)
+    log.info("   预期供应商: %s", expected_supplier_name)
+
+    # 使用 get-products 接口获取产品信息（跳过店铺匹配）
+    log.info("📋 通过产品ID获取产品信息...")
+    product_was_cached = product_cache_key(SP_API_KEY, sp_product_id) in PRODUCT_CACHE
+    product_detail = get_product_by_id(SP_API_KEY, sp_product_id)
+    actual_supplier_name = get_supplier_name(product_detail) if product_detail else None
+
+    # 缓存中的供应商与预期不一致：可能是缓存过期，强制从SP重新获取后再判断
+    if product_was_cached and product_detail and expected_supplier_name != actual_supplier_name:
+        log.info("   ♻️  缓存的供应商与预期不一致，重新获取产品信息...")
+        product_detail = get_product_by_id(SP_API_KEY, sp_product_id, use_cache=False)
+        actual_supplier_name = get_supplier_name(product_detail) if product_detail else None
+
+    # 本地映射可能已过期：重新查询接口确认
+    if from_store and (not product_detail or expected_supplier_name != actual_supplier_name):
+        reason = "产品不存在" if not product_detail else "供应商不一致"
+        log.info("♻️  本地映射可能已过期（%s），重新查询sp_productid接口...", reason)
+        invalidate_keer_mapping(keer_product_id)
+
+        fresh_product_id, fresh_supplier_name = get_product_id_by_keer_id(keer_product_id)
+        if not fresh_product_id or not fresh_supplier_name:
+            log.warning("⚠️  重新查询失败，降级到标题搜索")
+            return (None, None, None)
+
+        save_keer_mapping(keer_product_id, fresh_product_id, fresh_supplier_name)
+        expected_supplier_name = fresh_supplier_name
+
+        if str(fresh_product_id) != str(sp_product_id):
+            sp_product_id = fresh_product_id
+            product_detail = get_product_by_id(SP_API_KEY, sp_product_id)
+            actual_supplier_name = get_supplier_name(product_detail) if product_detail else None
+
+    if not product_detail:
+        # 产品在SP上不存在，不保留映射，下次直接查询接口
+        invalidate_keer_mapping(keer_product_id)
+        log.warning("⚠️  获取产品信息失败，降级到标题搜索")
+        return (None, None, None)
+
+    log.info("   实际供应商: %s", actual_supplier_name)
+
+    # 对比供应商名称（大小写敏感）
+    sp_status_message = None
+    if expected_supplier_name != actual_supplier_name:
+        sp_status_message = f"当前产品在{expected_supplier_name}账号，现在在{actual_supplier_name}账号"
+        log.warning("⚠️  供应商不一致!")
+        log.info("   预期: %s", expected_supplier_name)
+        log.info("   实际: %s", actual_supplier_name)
+        log.info("   sp_status: %s", sp_status_message)
+    else:
+        log.info("✅ 供应商一致，无需设置sp_status")
+
+    return (sp_product_id, product_detail, sp_status_message)
+
+
+class StoreMatcher:
+    """
+    预编译的店铺匹配器
+
+    由 SUPPLIER_NAME_TO_CODE 构建一次索引（报价人员 → 代码前缀，代码前缀 → 报价人员），
+    匹配时按 store_code 中的 "-" 位置直接查字典，不再为每个候选产品拼接组合代码
+    """
+
+    def __init__(self, supplier_name_to_code):
+        self.name_to_code = dict(supplier_name_to_code)
+        self.code_to_names = {}
+        for supplier_name, code_prefix in self.name_to_code.items():
+            self.code_to_names.setdefault(code_prefix, []).append(supplier_name)
+
+    def code_remainders(self, store_code):
+        """
+        找出 store_code 以哪些 "{代码前缀}-" 开头
+
+        返回: {代码前缀: 去掉 "{代码前缀}-" 后剩余的部分}
+        """
+        remainders = {}
+        position = store_code.find('-')
+        while position != -1:
+            code_prefix = store_code[:position]
+            if code_prefix in self.code_to_names:
+                remainders[code_prefix] = store_code[position + 1:]
+            position = store_code.find('-', position + 1)
+        return remainders
+
+    def match_by_supplier(self, products, store_code):
+        """
+        方法1: 报价人员代码前缀 + 产品店铺 组合后与 store_code 完全匹配或前缀匹配
+
+        返回: (product, code_prefix)，未匹配返回 (None, None)
+        """
+        remainders = self.code_remainders(store_code)
+        if not remainders:
+            return None, None
+
+        for product in products:
+            supplier_detail = product.get('supplier_detail', {})
+            supplier_name = supplier_detail.get('name', '') if isinstance(supplier_detail, dict) else ''
+            if not supplier_name:
+                continue
+
+            code_prefix = self.name_to_code.get(supplier_name)
+            remainder = remainders.get(code_prefix) if code_prefix else None
+            if remainder is not None and remainder.startswith(f"{product.get('store', '')}"):
+                return product, code_prefix
+
+        return None, None
+
+    @staticmethod
+    def match_legacy(products, store_code):
+        """
+        方法2: 传统匹配，一次遍历
+        店铺完全相同的产品优先，其次是第一个包含 store_code 任一片段（长度>3）的产品
+
+        返回: (product, is_exact)，未匹配返回 (None, False)
+        """
+        store_parts = [part for part in store_code.split('-') if part and len(part) > 3]
+        first_partial = None
+
+        for product in products:
+            product_store = product.get('store', '')
+
+            if store_code == product_store:
+                return product, True
+
+            if first_partial is None and isinstance(product_store, str):
+                if any(part in product_store for part in store_parts):
+                    first_partial = product
+
+        return first_partial, False
+
+
+STORE_MATCHER = StoreMatcher(SUPPLIER_NAME_TO_CODE)
+
+
+def match_product_by_store(products, store_code):
+    """
+    根据店铺编码和报价人员匹配产品
+
+    匹配逻辑：
+    1. 从产品的 supplier_detail.name 获取报价人员名称
+    2. 使用 SUPPLIER_NAME_TO_CODE 映射转换为代码前缀
+    3. 将代码前缀与产品的 store 字段组合 (用 - 连接)
+    4. 与任务的 store_code 进行匹配
+
+    示例：
+    - supplier_name = "Liu Hong" → code_prefix = "SQQ-SP00001"
+    - product_store = "pqf5ud-v0"
+    - combined = "SQQ-SP00001-pqf5ud-v0"
+    - 匹配 store_code = "SQQ-SP00001-pqf5ud-v0"
+
+    索引由 STORE_MATCHER 预先构建
+    """
+    if not products or not store_code:
+        return None
+
+    log.info("🔍 开始匹配店铺编码: %s (候选产品: %s 个)", store_code, len(products))
+
+    # 方法1: 使用报价人员名称匹配 (优先级最高)
+    product, code_prefix = STORE_MATCHER.match_by_supplier(products, store_code)
+    if product:
+        combined_store_code = f"{code_prefix}-{product.get('store', '')}"
+        match_type = "完全匹配" if combined_store_code == store_code else "前缀匹配"
+        log.info("   ✅ %s! 产品: %s | 报价人员: %s | 组合代码: %s",
+                 match_type, product.get('product_id'), product['supplier_detail']['name'], combined_store_code)
+        return product
+
+    log.warning("   ⚠️  未通过报价人员匹配到产品，尝试传统匹配...")
+
+    # 方法2: 传统匹配方法（作为后备）
+    product, is_exact = STORE_MATCHER.match_legacy(products, store_code)
+    if product:
+        if is_exact:
+            log.info("   ✅ 完全匹配: %s", product.get('store'))
+        else:
+            log.info("   ✓ 部分匹配: %s", product.get('store'))
+            log.info("   → 使用第一个匹配的产品")
+        return product
+
+    log.warning("   ⚠️  未找到匹配的店铺，使用第一个产品")
+    return products[0] if products else None
+
+
+def get_product_quotation(api_key, product_id, is_quotation_product=2, is_attachment_needed=1):
+    """
+    获取产品详细报价信息
+    """
+    url = f"{SP_BASE_URL}/get-product-quotation"
+    payload = {
+        "product_id": product_id,
+        "is_quotation_product": is_quotation_product,
+        "is_attachment_needed": is_attachment_needed
+    }
+
+    try:
+        response = get_sp_session(api_key).post(url, **json_request(payload), timeout=30)
+        response.raise_for_status()
+        return json_response(response)
+    except Exception as e:
+        log.error("获取产品详情失败: %s", e)
+        return None
+
+
+def update_product_quotation(api_key, quotation_data):
+    """
+    更新/回传产品报价
+    无论成功与否都作废该产品的信息缓存（写入后产品信息可能已变化）
+    """
+    url = f"{SP_BASE_URL}/update-product-quotation"
+    try:
+        response = get_sp_session(api_key).post(url, **json_request(quotation_data), timeout=30)
+        response.raise_for_status()
+        return json_response(response)
+    except Exception as e:
+        log.error("更新报价失败: %s", e)
+        return None
+    finally:
+        if quotation_data.get('product_id') is not None:
+            invalidate_product_cache(quotation_data['product_id'], api_key)
+
+
+QUOTATION_MESSAGE_ID_FIELDS = ("quotation_id", "client_account_id", "client_user_id", "quotation_request_id")
+
+QUOTATION_ID_STATS = {
+    "from_update": 0,
+    "from_detail": 0,
+    "light_refetch": 0
+}
+_quotation_id_stats_lock = threading.Lock()
+
+
+def _extract_message_ids(result_data):
+    """
+    从接口返回的 data（dict 或 list）中提取发送消息所需的ID，字段不全返回 None
+    """
+    if isinstance(result_data, list):
+        result_data = result_data[0] if result_data else None
+    if not isinstance(result_data, dict):
+        return None
+
+    message_ids = {field: result_data.get(field) for field in QUOTATION_MESSAGE_ID_FIELDS}
+    if any(value in (None, '') for value in message_ids.values()):
+        return None
+    return message_ids
+
+
+def resolve_message_ids(api_key, product_id, update_result, product_detail):
+    """
+    获取发送消息所需的 quotation_id / client_account_id / client_user_id / quotation_request_id
+
+    优先使用报价提交的响应，其次是提交前获取的产品详情；
+    都不完整时才重新获取一次不带附件的产品详情
+
+    返回: dict，失败返回 None
+    """
+    sources = (
+        ("from_update", (update_result or {}).get('data')),
+        ("from_detail", product_detail)
+    )
+    for source, result_data in sources:
+        message_ids = _extract_message_ids(result_data)
+        if message_ids:
+            with _quotation_id_stats_lock:
+                QUOTATION_ID_STATS[source] += 1
+            return message_ids
+
+    with _quotation_id_stats_lock:
+        QUOTATION_ID_STATS["light_refetch"] += 1
+
+    detail_result = get_product_quotation(api_key, product_id, is_attachment_needed=0)
+    if not detail_result or not detail_result.get('success'):
+        return None
+
+    detail_data = detail_result.get('data') or [{}]
+    return {field: detail_data[0].get(field) for field in QUOTATION_MESSAGE_ID_FIELDS}
 
-        except Exception as e:
-            print(f"   ⚠️  请求失败: {e}")
-            continue
 
-    print(f"\n   ❌ 所有尝试均失败")
-    return (False, "所有API调用均失败")
+def print_quotation_id_stats():
+    """
+    输出报价后获取消息ID的来源统计（每次复用即少一次带附件的产品详情请求）
+    """
+    with _quotation_id_stats_lock:
+        stats = dict(QUOTATION_ID_STATS)
 
+    reused = stats['from_update'] + stats['from_detail']
+    if not reused and not stats['light_refetch']:
+        return
 
-def match_product_by_store(products, store_code):
+    log.info("🧾 报价ID获取 (累计): 复用响应 %s 次 (提交响应 %s, 首次详情 %s), 轻量重新获取 %s 次, 节省带附件详情请求 %s 次",
+             reused, stats['from_update'], stats['from_detail'], stats['light_refetch'], reused + stats['light_refetch'])
+
+
+def extract_existing_prices(quotation_information, country_mapping):
     """
-    根据店铺编码和报价人员匹配产品
+    从产品详情的 quotation_information 中提取SP上已有的报价
 
-    匹配逻辑：
-    1. 从产品的 supplier_detail.name 获取报价人员名称
-    2. 使用 SUPPLIER_NAME_TO_CODE 映射转换为代码前缀
-    3. 将代码前缀与产品的 store 字段组合 (用 - 连接)
-    4. 与任务的 store_code 进行匹配
+    只读取变体上的 "pcs_{数量}": 价格 字段（与 update-product-quotation 的参数同名，
+    去掉了变体和国家后缀），不猜测其他字段
 
-    示例：
-    - supplier_name = "Liu Hong" → code_prefix = "SQQ-SP00001"
-    - product_store = "pqf5ud-v0"
-    - combined = "SQQ-SP00001-pqf5ud-v0"
-    - 匹配 store_code = "SQQ-SP00001-pqf5ud-v0"
+    返回: {pcs_{quantity}_{variant_id}_{country_id}: 已有报价}，提取不到时为空dict
+          价格不是单个值时返回None（无法确定已有报价）
     """
-    if not products or not store_code:
-        return None
+    existing_prices = {}
+    if not isinstance(quotation_information, dict):
+        return existing_prices
 
-    print(f"\n🔍 开始匹配店铺编码: {store_code}")
+    for country_code, variants in quotation_information.items():
+        country_id = country_mapping.get(country_code)
+        if not country_id or not variants:
+            continue
 
-    # 方法1: 使用报价人员名称匹配 (优先级最高)
-    for product in products:
-        # 获取报价人员名称
-        supplier_detail = product.get('supplier_detail', {})
-        supplier_name = supplier_detail.get('name', '') if isinstance(supplier_detail, dict) else ''
-        product_store = product.get('store', '')
-
-        if supplier_name and supplier_name in SUPPLIER_NAME_TO_CODE:
-            # 获取代码前缀
-            code_prefix = SUPPLIER_NAME_TO_CODE[supplier_name]
-            # 组合完整的店铺代码
-            combined_store_code = f"{code_prefix}-{product_store}"
-
-            print(f"   🔍 产品: {product.get('product_id')}")
-            print(f"      报价人员: {supplier_name}")
-            print(f"      代码前缀: {code_prefix}")
-            print(f"      产品店铺: {product_store}")
-            print(f"      组合代码: {combined_store_code}")
-
-            # 完全匹配
-            if combined_store_code == store_code:
-                print(f"   ✅ 完全匹配!")
-                return product
-
-            # 部分匹配（任务store_code以组合代码开头）
-            if store_code.startswith(combined_store_code):
-                print(f"   ✅ 前缀匹配!")
-                return product
-
-    print(f"   ⚠️  未通过报价人员匹配到产品，尝试传统匹配...")
+        for variant in variants:
+            variant_id = variant.get('variant_id') if isinstance(variant, dict) else None
+            if not variant_id:
+                continue
 
-    # 方法2: 传统匹配方法（作为后备）
-    store_parts = store_code.split('-')
-    matched_products = []
+            for key, price in variant.items():
+                if not (isinstance(key, str) and key.startswith('pcs_') and key[4:].isdigit()):
+                    continue
+                if price in (None, ''):
+                    continue
+                if isinstance(price, (dict, list)):
+                    return None
+                existing_prices[f"{key}_{variant_id}_{country_id}"] = price
 
-    for product in products:
-        product_store = product.get('store', '')
+    return existing_prices
 
-        if store_code == product_store:
-            print(f"   ✅ 完全匹配: {product_store}")
-            return product
 
-        is_match = False
-        for part in store_parts:
-            if part and len(part) > 3 and part in product_store:
-                is_match = True
-                break
+def _same_price(existing_price, price_text):
+    """
+    已有报价与本次报价（字符串）是否相同，按两位小数比较
+    """
+    if existing_price is None:
+        return False
+    try:
+        return round(float(existing_price), 2) == float(price_text)
+    except (TypeError, ValueError):
+        return str(existing_price) == price_text
+
 
-        if is_match:
-            matched_products.append(product)
-            print(f"   ✓ 部分匹配: {product_store}")
+QUOTATION_SUBMIT_STATS = {
+    "full": 0,
+    "skipped": 0
+}
+_quotation_submit_stats_lock = threading.Lock()
 
-    if matched_products:
-        print(f"   → 使用第一个匹配的产品")
-        return matched_products[0]
 
-    print(f"   ⚠️  未找到匹配的店铺，使用第一个产品")
-    return products[0] if products else None
+def count_quotation_submission(kind):
+    with _quotation_submit_stats_lock:
+        QUOTATION_SUBMIT_STATS[kind] += 1
 
 
-def get_product_quotation(api_key, product_id, is_quotation_product=2, is_attachment_needed=1):
+def _same_base_fields(quotation_payload, product_detail):
     """
-    获取产品详细报价信息
+    报价参数中的非价格字段（处理时间、产品质量等）是否与产品详情中的值一致
+    详情中缺少某个字段时视为不一致
     """
-    url = f"{SP_BASE_URL}/get-product-quotation"
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
+    for key, value in quotation_payload.items():
+        if key.startswith('pcs_') or key == 'delete_variant' or key in QUOTATION_REQUEST_ONLY_FIELDS:
+            continue
+        if key not in product_detail or str(product_detail[key]) != str(value):
+            return False
+    return True
 
-    payload = {
-        "product_id": product_id,
-        "is_quotation_product": is_quotation_product,
-        "is_attachment_needed": is_attachment_needed
-    }
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f"获取产品详情失败: {e}")
-        return None
+def plan_quotation_submission(quotation_payload, price_params, delete_variant_data, product_detail,
+                              country_mapping):
+    """
+    对比产品详情中已有的报价，决定如何提交
 
+    返回: (方式, 要提交的参数)
+    - ("skipped", None): 非价格字段和所有价格都与SP上一致、没有多出的已有报价且无需删除变体，不需要提交
+    - ("full", quotation_payload): 完整提交（提取不到已有报价，或详情格式不符合预期时也是完整提交）
+    """
+    if not QUOTATION_SKIP_UNCHANGED:
+        return "full", quotation_payload
 
-def update_product_quotation(api_key, quotation_data):
+    existing_prices = extract_existing_prices(product_detail.get('quotation_information'), country_mapping)
+    if not existing_prices:
+        return "full", quotation_payload
+
+    changed_params = {name: price_text for name, price_text in price_params.items()
+                      if not _same_price(existing_prices.get(name), price_text)}
+
+    if (not changed_params and not delete_variant_data
+            and existing_prices.keys() == price_params.keys()
+            and _same_base_fields(quotation_payload, product_detail)):
+        return "skipped", None
+
+    return "full", quotation_payload
+
+
+def print_quotation_submit_stats():
     """
-    更新/回传产品报价
+    输出报价提交方式统计（累计）
     """
-    url = f"{SP_BASE_URL}/update-product-quotation"
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
+    with _quotation_submit_stats_lock:
+        stats = dict(QUOTATION_SUBMIT_STATS)
 
-    try:
-        response = requests.post(url, headers=headers, json=quotation_data, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f"更新报价失败: {e}")
-        return None
+    if not any(stats.values()):
+        return
+
+    log.info("📤 报价提交 (累计): 完整 %s 次, 未变化跳过 %s 次", stats['full'], stats['skipped'])
 
 
 def send_product_message(api_key, message_data, image_files=None):
@@ -875,11 +3201,6 @@ def send_product_message(api_key, message_data, image_files=None):
     发送产品消息和图片
     """
     url = f"{SP_BASE_URL}/save-product-chat-messages"
-    headers = {
-        "X-Service-Point-Access-Token": api_key,
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "product_id": message_data['product_id'],
         "quotation_id": message_data['quotation_id'],
@@ -891,16 +3212,83 @@ def send_product_message(api_key, message_data, image_files=None):
         "description": message_data['description']
     }
 
-    if image_files:
-        payload["myProductfiles"] = image_files
-
+    body = None
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        body, body_size = write_message_body(payload, image_files)
+        log.info("   📦 请求体大小: %.2f MB%s",
+                 body_size / 1024 / 1024, ' (已转存临时文件)' if body_size > UPLOAD_SPOOL_MAX_MEMORY else '')
+
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Length": str(body_size)
+        }
+        response = get_sp_session(api_key).post(url, headers=headers, data=MessageBodyReader(body, body_size),
+                                                timeout=60)
         response.raise_for_status()
-        return response.json()
+        return json_response(response)
     except Exception as e:
-        print(f"发送消息失败: {e}")
+        log.error("发送消息失败: %s", e)
         return None
+    finally:
+        if body is not None:
+            body.close()
+
+
+class MessageBodyReader:
+    """
+    把请求体文件交给 requests 时的包装：提供长度和 read，不提供 fileno/tell
+
+    requests 计算长度时会调用文件对象的 fileno()，SpooledTemporaryFile
+    因此总会转存到磁盘；包装后只有超过 UPLOAD_SPOOL_MAX_MEMORY 的请求体才会落盘
+    """
+
+    def __init__(self, body, size):
+        self._body = body
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+
+def write_message_body(payload, image_files=None):
+    """
+    流式构建 save-product-chat-messages 的JSON请求体
+
+    图片以原始字节传入，按块base64编码后直接写入请求体，请求体超过
+    UPLOAD_SPOOL_MAX_MEMORY 后自动转存到临时文件，完整请求体不会在内存中再复制一份
+
+    返回:
+        (已seek到开头的文件对象, 请求体字节数)
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
+
+    head = json_dumps_bytes(payload)
+    if not image_files:
+        body.write(head)
+    else:
+        body.write(head[:-1])
+        body.write(b',"myProductfiles":[')
+
+        for file_index, image_file in enumerate(image_files):
+            if file_index > 0:
+                body.write(b',')
+
+            body.write(b'{"name":' + json_dumps_bytes(image_file["name"]) + b',"data":"')
+
+            content = memoryview(image_file['content'])
+            for offset in range(0, len(content), UPLOAD_BASE64_CHUNK):
+                body.write(base64.b64encode(content[offset:offset + UPLOAD_BASE64_CHUNK]))
+
+            body.write(b'","type":' + json_dumps_bytes(image_file["type"]) + b'}')
+
+        body.write(b']}')
+
+    body_size = body.tell()
+    body.seek(0)
+    return body, body_size
 
 
 # ==================== 国家代码映射 ====================
@@ -925,13 +3313,13 @@ def get_country_id_mapping(quotation_info):
 
 # ==================== 核心处理函数 ====================
 
-def process_non_quotable_task(task_data):
+def process_non_quotable_task(task_data, status):
     """
     处理标记不可报价任务
     """
-    print("\n" + "=" * 100)
-    print("开始处理标记不可报价任务")
-    print("=" * 100)
+    log.info("=" * 100)
+    log.info("开始处理标记不可报价任务")
+    log.info("=" * 100)
 
     # 1. 提取任务信息
     client_product_title = task_data.get('client_product_title')
@@ -939,80 +3327,49 @@ def process_non_quotable_task(task_data):
     keer_product_id = task_data.get('keer_product_id')
 
     if not client_product_title:
-        print("❌ 错误: 缺少产品标题")
+        log.error("❌ 错误: 缺少产品标题")
         return False
 
     if not keer_product_id:
-        print("❌ 错误: 缺少keer_product_id")
+        log.error("❌ 错误: 缺少keer_product_id")
         return False
 
-    print(f"\n📦 产品标题: {client_product_title}")
-    print(f"🏪 店铺代码: {store_code}")
-    print(f"🆔 Keer产品ID: {keer_product_id}")
+    log.info("📦 产品标题: %s", client_product_title)
+    log.info("🏪 店铺代码: %s", store_code)
+    log.info("🆔 Keer产品ID: %s", keer_product_id)
 
-    # 2. 获取产品ID（优先使用新接口，失败则降级到标题搜索）
-    print(f"\n🔍 尝试通过Keer产品ID获取SP产品ID...")
-    sp_product_id, expected_supplier_name = get_product_id_by_keer_id(keer_product_id)
+    # 2. 获取产品ID（优先使用本地映射和新接口，失败则降级到标题搜索）
+    log.info("🔍 尝试通过Keer产品ID获取SP产品ID...")
+    sp_product_id, product_detail_temp, sp_status_message = resolve_product_by_keer_id(keer_product_id)
 
     product_id = None
     shopify_product_id = None
-    actual_supplier_name = None
-    sp_status_message = None
 
     # 方案A: 新接口成功
-    if sp_product_id and expected_supplier_name:
-        print(f"\n✅ 使用新接口获取的产品ID: {sp_product_id}")
-        print(f"   预期供应商: {expected_supplier_name}")
-
-        # 使用 get-products 接口获取产品信息（跳过店铺匹配）
-        print(f"\n📋 通过产品ID获取产品信息...")
-        product_detail_temp = get_product_by_id(SP_API_KEY, sp_product_id)
-
-        if product_detail_temp:
-            # 提取实际的供应商名称
-            supplier_detail = product_detail_temp.get('supplier_detail', {})
-            if isinstance(supplier_detail, dict):
-                actual_supplier_name = supplier_detail.get('name', '')
-
-            print(f"   实际供应商: {actual_supplier_name}")
-
-            # 对比供应商名称（大小写敏感）
-            if expected_supplier_name != actual_supplier_name:
-                sp_status_message = f"当前产品在{expected_supplier_name}账号，现在在{actual_supplier_name}账号"
-                print(f"\n⚠️  供应商不一致!")
-                print(f"   预期: {expected_supplier_name}")
-                print(f"   实际: {actual_supplier_name}")
-                print(f"   sp_status: {sp_status_message}")
-            else:
-                print(f"✅ 供应商一致，无需设置sp_status")
-
-            # 使用新接口获取的产品信息
-            product_id = sp_product_id
-            shopify_product_id = product_detail_temp.get('product_shopify_id')
-
-            print(f"\n✅ 使用产品:")
-            print(f"   产品ID: {product_id}")
-            print(f"   Shopify ID: {shopify_product_id}")
-            print(f"   店铺: {product_detail_temp.get('store')}")
-            print(f"   产品名称: {product_detail_temp.get('product_name')}")
-            print(f"   状态: {product_detail_temp.get('status')}")
-        else:
-            print(f"⚠️  获取产品信息失败，降级到标题搜索")
-            sp_product_id = None
+    if sp_product_id:
+        # 使用新接口获取的产品信息
+        product_id = sp_product_id
+        shopify_product_id = product_detail_temp.get('product_shopify_id')
+
+        log.info("✅ 使用产品:")
+        log.debug("   产品ID: %s", product_id)
+        log.debug("   Shopify ID: %s", shopify_product_id)
+        log.debug("   店铺: %s", product_detail_temp.get('store'))
+        log.debug("   产品名称: %s", product_detail_temp.get('product_name'))
+        log.debug("   状态: %s", product_detail_temp.get('status'))
 
     # 方案B: 新接口失败，降级到标题搜索
     if not sp_product_id:
-        print(f"\n🔄 降级到标题搜索模式...")
-        print(f"🔍 正在搜索Service Points产品...")
+        log.info("🔄 降级到标题搜索模式...")
+        log.info("🔍 正在搜索Service Points产品...")
         search_result = search_products_by_title(SP_API_KEY, client_product_title)
 
         if not search_result or not search_result.get('success'):
-            print(f"⚠️  搜索产品失败: {search_result}")
+            log.warning("⚠️  搜索产品失败: %s", search_result)
 
             # ✅ 产品不存在 - 标记为失败
-            print(f"❌ 产品在Service Points平台上不存在")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.error("❌ 产品在Service Points平台上不存在")
+            status.save(
                 sp_status="产品链接消失",
                 quotation_feedback_status=2
             )
@@ -1021,29 +3378,27 @@ def process_non_quotable_task(task_data):
         products = search_result.get('data', {}).get('products_data', [])
 
         if not products:
-            print(f"❌ 产品在Service Points平台上不存在")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.error("❌ 产品在Service Points平台上不存在")
+            status.save(
                 sp_status="产品链接消失",
                 quotation_feedback_status=2
             )
             return False
 
         # 根据店铺编码匹配产品
-        print(f"\n📋 找到 {len(products)} 个匹配产品")
+        log.info("📋 找到 %s 个匹配产品", len(products))
         if len(products) > 1:
-            print(f"多个产品匹配，开始智能匹配:")
+            log.info("多个产品匹配，开始智能匹配:")
             for i, p in enumerate(products, 1):
                 supplier_detail = p.get('supplier_detail', {})
                 supplier_name = supplier_detail.get('name', '') if isinstance(supplier_detail, dict) else ''
-                print(f"   {i}. ID:{p.get('product_id')} | 店铺:{p.get('store')} | 报价人员:{supplier_name}")
+                log.debug("   %s. ID:%s | 店铺:%s | 报价人员:%s", i, p.get('product_id'), p.get('store'), supplier_name)
 
         product = match_product_by_store(products, store_code)
 
         if not product:
-            print(f"❌ 店铺匹配失败")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.error("❌ 店铺匹配失败")
+            status.save(
                 sp_status="店铺匹配失败",
                 quotation_feedback_status=2
             )
@@ -1052,65 +3407,67 @@ def process_non_quotable_task(task_data):
         product_id = product.get('product_id')
         shopify_product_id = product.get('product_shopify_id')
 
-        print(f"\n✅ 使用产品:")
-        print(f"   产品ID: {product_id}")
-        print(f"   Shopify ID: {shopify_product_id}")
-        print(f"   店铺: {product.get('store')}")
-        print(f"   产品名称: {product.get('product_name')}")
-        print(f"   状态: {product.get('status')}")
+        log.info("✅ 使用产品:")
+        log.debug("   产品ID: %s", product_id)
+        log.debug("   Shopify ID: %s", shopify_product_id)
+        log.debug("   店铺: %s", product.get('store'))
+        log.debug("   产品名称: %s", product.get('product_name'))
+        log.debug("   状态: %s", product.get('status'))
 
     # 4. 标记产品不可报价
-    print(f"\n🚫 正在标记产品为不可报价...")
+    log.info("🚫 正在标记产品为不可报价...")
     success, message = mark_product_non_quotable(SP_API_KEY, product_id, shopify_product_id)
+    # 写入后产品信息可能已变化，缓存中的旧信息不再使用
+    invalidate_product_cache(product_id)
 
     if not success:
-        print(f"\n❌ 标记失败: {message}")
+        log.error("❌ 标记失败: %s", message)
 
         # 根据不同的失败原因保存不同的状态
         if "产品已报价" in message:
-            save_task_status(
-                keer_product_id=keer_product_id,
+            status.save(
                 sp_status="产品已报价，无法标记不可报价",
                 quotation_feedback_status=2
             )
         else:
-            save_task_status(
-                keer_product_id=keer_product_id,
+            status.save(
                 sp_status="标记不可报价失败",
                 quotation_feedback_status=2
             )
         return False
 
-    print(f"\n✅✅✅ 标记成功! ✅✅✅")
+    log.info("✅✅✅ 标记成功! ✅✅✅")
 
     # 5. 保存成功状态
-    print(f"\n📝 保存成功状态...")
+    log.info("📝 保存成功状态...")
     if sp_status_message:
-        save_task_status(
-            keer_product_id=keer_product_id,
+        status.save(
             sp_status=sp_status_message,
             quotation_feedback_status=1
         )
     else:
-        save_task_status(
-            keer_product_id=keer_product_id,
+        status.save(
             quotation_feedback_status=1
         )
 
-    # ✅ 6. 调用update_sp_status接口
-    update_sp_status(keer_product_id)
+    # ✅ 6. 调用update_sp_status接口（任务结束时统一回写）
+    status.mark_sp_completed()
+    record_task_completed('non_quotable', task_data)
 
-    print(f"\n🎉🎉🎉 标记不可报价任务处理完成! 🎉🎉🎉")
+    log.info("🎉🎉🎉 标记不可报价任务处理完成! 🎉🎉🎉")
     return True
 
 
-def process_quotation_task(task_data):
+def quotation_lookup_stage(ctx):
     """
-    处理单个报价任务
+    报价任务阶段：校验任务、解析报价结果、定位SP产品并获取产品详情
     """
-    print("\n" + "=" * 100)
-    print("开始处理报价任务")
-    print("=" * 100)
+    task_data = ctx['task_data']
+    status = ctx['status']
+
+    log.info("=" * 100)
+    log.info("开始处理报价任务")
+    log.info("=" * 100)
 
     # 1. 提取任务信息
     client_product_title = task_data.get('client_product_title')
@@ -1119,44 +3476,42 @@ def process_quotation_task(task_data):
     keer_product_id = task_data.get('keer_product_id')
 
     if not client_product_title:
-        print("❌ 错误: 缺少产品标题")
+        log.error("❌ 错误: 缺少产品标题")
         return False
 
     if not quotation_result_str:
-        print("❌ 错误: 缺少报价结果")
+        log.error("❌ 错误: 缺少报价结果")
         return False
 
     if not keer_product_id:
-        print("❌ 错误: 缺少keer_product_id")
+        log.error("❌ 错误: 缺少keer_product_id")
         return False
 
-    print(f"📦 产品标题: {client_product_title}")
-    print(f"🏪 店铺代码: {store_code}")
-    print(f"🆔 Keer产品ID: {keer_product_id}")
+    log.info("📦 产品标题: %s", client_product_title)
+    log.info("🏪 店铺代码: %s", store_code)
+    log.info("🆔 Keer产品ID: %s", keer_product_id)
 
     # 2. 解析报价结果
     try:
-        quotation_result = json.loads(quotation_result_str)
-        print(f"📊 报价数量: {len(quotation_result)} 条")
+        quotation_result = json_loads(quotation_result_str)
+        log.info("📊 报价数量: %s 条", len(quotation_result))
 
-        valid_quotes = [q for q in quotation_result if q.get('price', 0) > 0]
-        zero_price_quotes = [q for q in quotation_result if q.get('price', 0) == 0]
+        compiled_quotation = CompiledQuotation(quotation_result)
 
-        print(f"   ✅ 有效报价: {len(valid_quotes)} 条")
-        if zero_price_quotes:
-            print(f"   ⚠️  跳过价格为0的报价: {len(zero_price_quotes)} 条")
+        log.info("   ✅ 有效报价: %s 条", compiled_quotation.valid_count)
+        if compiled_quotation.zero_count:
+            log.warning("   ⚠️  跳过价格为0的报价: %s 条", compiled_quotation.zero_count)
 
         # ✅ 如果所有价格都是0，标记失败
-        if len(valid_quotes) == 0:
-            print(f"\n❌ 所有报价价格都为0，无法回传")
-            save_task_status(
-                keer_product_id=keer_product_id,
+        if compiled_quotation.valid_count == 0:
+            log.error("❌ 所有报价价格都为0，无法回传")
+            status.save(
                 sp_status="价格全为0，无法回传",
                 quotation_feedback_status=2
             )
             return False
 
-        print("\n💰 报价详情（显示前20条）:")
+        log.debug("💰 报价详情（显示前20条）:")
         display_count = min(20, len(quotation_result))
         for i in range(display_count):
             quote = quotation_result[i]
@@ -1164,77 +3519,46 @@ def process_quotation_task(task_data):
             original_nation = quote.get('nation')
             normalized_nation = normalize_country_code(original_nation)
             nation_display = f"{original_nation} -> {normalized_nation}" if original_nation != normalized_nation else original_nation
-            print(f"   {i + 1}. {price_status} 国家:{nation_display} | 数量:{quote.get('quantity')} | "
-                  f"价格:{quote.get('price')} | 利润:{quote.get('profit')}")
+            log.debug("   %s. %s 国家:%s | 数量:%s | 价格:%s | 利润:%s",
+                      i + 1, price_status, nation_display, quote.get('quantity'), quote.get('price'), quote.get('profit'))
 
         if len(quotation_result) > 20:
-            print(f"   ... 还有 {len(quotation_result) - 20} 条报价未显示")
+            log.debug("   ... 还有 %s 条报价未显示", len(quotation_result) - 20)
 
     except json.JSONDecodeError as e:
-        print(f"❌ 错误: 解析报价结果失败 - {e}")
+        log.error("❌ 错误: 解析报价结果失败 - %s", e)
         return False
 
-    # 3. 获取产品ID（优先使用新接口，失败则降级到标题搜索）
-    print(f"\n🔍 尝试通过Keer产品ID获取SP产品ID...")
-    sp_product_id, expected_supplier_name = get_product_id_by_keer_id(keer_product_id)
+    # 3. 获取产品ID（优先使用本地映射和新接口，失败则降级到标题搜索）
+    log.info("🔍 尝试通过Keer产品ID获取SP产品ID...")
+    sp_product_id, product_detail_temp, sp_status_message = resolve_product_by_keer_id(keer_product_id)
 
     product_id = None
     shopify_product_id = None
-    actual_supplier_name = None
-    sp_status_message = None
 
     # 方案A: 新接口成功
-    if sp_product_id and expected_supplier_name:
-        print(f"\n✅ 使用新接口获取的产品ID: {sp_product_id}")
-        print(f"   预期供应商: {expected_supplier_name}")
-
-        # 使用 get-products 接口获取产品信息（跳过店铺匹配）
-        print(f"\n📋 通过产品ID获取产品信息...")
-        product_detail_temp = get_product_by_id(SP_API_KEY, sp_product_id)
-
-        if product_detail_temp:
-            # 提取实际的供应商名称
-            supplier_detail = product_detail_temp.get('supplier_detail', {})
-            if isinstance(supplier_detail, dict):
-                actual_supplier_name = supplier_detail.get('name', '')
-
-            print(f"   实际供应商: {actual_supplier_name}")
-
-            # 对比供应商名称（大小写敏感）
-            if expected_supplier_name != actual_supplier_name:
-                sp_status_message = f"当前产品在{expected_supplier_name}账号，现在在{actual_supplier_name}账号"
-                print(f"\n⚠️  供应商不一致!")
-                print(f"   预期: {expected_supplier_name}")
-                print(f"   实际: {actual_supplier_name}")
-                print(f"   sp_status: {sp_status_message}")
-            else:
-                print(f"✅ 供应商一致，无需设置sp_status")
-
-            # 使用新接口获取的产品信息
-            product_id = sp_product_id
-            shopify_product_id = product_detail_temp.get('product_shopify_id')
-
-            print(f"\n✅ 使用产品:")
-            print(f"   产品ID: {product_id}")
-            print(f"   Shopify ID: {shopify_product_id}")
-            print(f"   店铺: {product_detail_temp.get('store')}")
-            print(f"   产品名称: {product_detail_temp.get('product_name')}")
-            print(f"   状态: {product_detail_temp.get('status')}")
-        else:
-            print(f"⚠️  获取产品信息失败，降级到标题搜索")
-            sp_product_id = None
+    if sp_product_id:
+        # 使用新接口获取的产品信息
+        product_id = sp_product_id
+        shopify_product_id = product_detail_temp.get('product_shopify_id')
+
+        log.info("✅ 使用产品:")
+        log.debug("   产品ID: %s", product_id)
+        log.debug("   Shopify ID: %s", shopify_product_id)
+        log.debug("   店铺: %s", product_detail_temp.get('store'))
+        log.debug("   产品名称: %s", product_detail_temp.get('product_name'))
+        log.debug("   状态: %s", product_detail_temp.get('status'))
 
     # 方案B: 新接口失败，降级到标题搜索
     if not sp_product_id:
-        print(f"\n🔄 降级到标题搜索模式...")
-        print(f"🔍 正在搜索Service Points产品...")
+        log.info("🔄 降级到标题搜索模式...")
+        log.info("🔍 正在搜索Service Points产品...")
         search_result = search_products_by_title(SP_API_KEY, client_product_title)
 
         if not search_result or not search_result.get('success'):
-            print(f"⚠️  搜索产品失败: {search_result}")
-            print(f"❌ 产品在Service Points平台上不存在")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.warning("⚠️  搜索产品失败: %s", search_result)
+            log.error("❌ 产品在Service Points平台上不存在")
+            status.save(
                 sp_status="产品链接消失",
                 quotation_feedback_status=2
             )
@@ -1243,29 +3567,27 @@ def process_quotation_task(task_data):
         products = search_result.get('data', {}).get('products_data', [])
 
         if not products:
-            print(f"❌ 产品在Service Points平台上不存在")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.error("❌ 产品在Service Points平台上不存在")
+            status.save(
                 sp_status="产品链接消失",
                 quotation_feedback_status=2
             )
             return False
 
         # 根据店铺编码匹配产品
-        print(f"\n📋 找到 {len(products)} 个匹配产品")
+        log.info("📋 找到 %s 个匹配产品", len(products))
         if len(products) > 1:
-            print(f"多个产品匹配，开始智能匹配:")
+            log.info("多个产品匹配，开始智能匹配:")
             for i, p in enumerate(products, 1):
                 supplier_detail = p.get('supplier_detail', {})
                 supplier_name = supplier_detail.get('name', '') if isinstance(supplier_detail, dict) else ''
-                print(f"   {i}. ID:{p.get('product_id')} | 店铺:{p.get('store')} | 报价人员:{supplier_name}")
+                log.debug("   %s. ID:%s | 店铺:%s | 报价人员:%s", i, p.get('product_id'), p.get('store'), supplier_name)
 
         product = match_product_by_store(products, store_code)
 
         if not product:
-            print(f"❌ 店铺匹配失败")
-            save_task_status(
-                keer_product_id=keer_product_id,
+            log.error("❌ 店铺匹配失败")
+            status.save(
                 quotation_feedback_status=2
             )
             return False
@@ -1273,30 +3595,28 @@ def process_quotation_task(task_data):
         product_id = product.get('product_id')
         shopify_product_id = product.get('product_shopify_id')
 
-        print(f"\n✅ 使用产品:")
-        print(f"   产品ID: {product_id}")
-        print(f"   Shopify ID: {shopify_product_id}")
-        print(f"   店铺: {product.get('store')}")
-        print(f"   产品名称: {product.get('product_name')}")
-        print(f"   状态: {product.get('status')}")
+        log.info("✅ 使用产品:")
+        log.debug("   产品ID: %s", product_id)
+        log.debug("   Shopify ID: %s", shopify_product_id)
+        log.debug("   店铺: %s", product.get('store'))
+        log.debug("   产品名称: %s", product.get('product_name'))
+        log.debug("   状态: %s", product.get('status'))
 
     # 5. 获取产品详细报价信息
-    print(f"\n📋 获取产品详细信息...")
+    log.info("📋 获取产品详细信息...")
     detail_result = get_product_quotation(SP_API_KEY, product_id, is_attachment_needed=1)
 
     if not detail_result or not detail_result.get('success'):
-        print(f"❌ 获取产品详情失败: {detail_result}")
-        save_task_status(
-            keer_product_id=keer_product_id,
+        log.error("❌ 获取产品详情失败: %s", detail_result)
+        status.save(
             quotation_feedback_status=2
         )
         return False
 
     detail_data = detail_result.get('data', [])
     if not detail_data:
-        print(f"❌ 产品详情为空")
-        save_task_status(
-            keer_product_id=keer_product_id,
+        log.error("❌ 产品详情为空")
+        status.save(
             quotation_feedback_status=2
         )
         return False
@@ -1304,39 +3624,55 @@ def process_quotation_task(task_data):
     product_detail = detail_data[0]
     quotation_information = product_detail.get('quotation_information', {})
 
-    print(f"✅ 获取到产品详情")
+    log.info("✅ 获取到产品详情")
+
+    ctx.update(
+        compiled_quotation=compiled_quotation,
+        product_id=product_id,
+        shopify_product_id=shopify_product_id,
+        sp_status_message=sp_status_message,
+        product_detail=product_detail,
+        quotation_information=quotation_information
+    )
+    return True
+
+
+def quotation_submit_stage(ctx):
+    """
+    报价任务阶段：构建并提交报价，获取发送消息所需的quotation_id等
+    """
+    status = ctx['status']
+    compiled_quotation = ctx['compiled_quotation']
+    product_id = ctx['product_id']
+    shopify_product_id = ctx['shopify_product_id']
+    product_detail = ctx['product_detail']
+    quotation_information = ctx['quotation_information']
 
     # 6. 提取国家代码映射和variant信息
     country_mapping = get_country_id_mapping(quotation_information)
-    print(f"\n🌍 国家映射: {country_mapping}")
+    log.info("🌍 国家映射: %s", country_mapping)
 
     country_variants = {}
     for country_code, variants in quotation_information.items():
         if variants:
             country_variants[country_code] = variants
-            print(f"   {country_code}: {len(variants)} 个变体")
+            log.debug("   %s: %s 个变体", country_code, len(variants))
 
     if not country_variants:
-        print(f"❌ 错误: 未找到产品变体信息")
-        save_task_status(
-            keer_product_id=keer_product_id,
+        log.error("❌ 错误: 未找到产品变体信息")
+        status.save(
             quotation_feedback_status=2
         )
         return False
 
     # ==================== 检测并准备删除缺失的国家 ====================
-    print(f"\n🔍 检查国家报价完整性...")
+    log.info("🔍 检查国家报价完整性...")
 
-    # 从报价数据中获取所有有报价的国家
-    countries_with_quotes = set()
-    for quote in quotation_result:
-        original_nation = quote.get('nation')
-        if original_nation and quote.get('price', 0) > 0:  # ✅ 只统计价格>0的国家
-            normalized_nation = normalize_country_code(original_nation)
-            countries_with_quotes.add(normalized_nation)
+    # 从报价数据中获取所有有报价的国家（价格>0）
+    countries_with_quotes = compiled_quotation.countries_with_quotes
 
-    print(f"   📊 Service Points产品包含国家: {set(country_variants.keys())}")
-    print(f"   📊 报价数据包含国家: {countries_with_quotes}")
+    log.debug("   📊 Service Points产品包含国家: %s", set(country_variants.keys()))
+    log.debug("   📊 报价数据包含国家: %s", countries_with_quotes)
 
     # 找出缺失的国家
     all_countries_in_sp = set(country_variants.keys())
@@ -1346,8 +3682,8 @@ def process_quotation_task(task_data):
     delete_variant_data = {}
 
     if missing_countries:
-        print(f"\n⚠️  检测到缺失国家: {missing_countries}")
-        print(f"   将在提交报价时同时删除这些国家的变体")
+        log.warning("⚠️  检测到缺失国家: %s", missing_countries)
+        log.info("   将在提交报价时同时删除这些国家的变体")
 
         # 按国家收集variant_id
         for missing_country in missing_countries:
@@ -1358,30 +3694,30 @@ def process_quotation_task(task_data):
             variants = country_variants.get(missing_country, [])
             variant_ids = []
 
-            print(f"\n   📋 国家 {missing_country} (country_id: {country_id}) 的变体:")
+            log.info("   📋 国家 %s (country_id: %s) 的变体:", missing_country, country_id)
             for idx, variant in enumerate(variants, 1):
                 variant_id = variant.get('variant_id')
                 if variant_id:
                     variant_ids.append(variant_id)
                     if idx <= 5:  # 只显示前5个
-                        print(f"      - variant_id: {variant_id}")
+                        log.debug("      - variant_id: %s", variant_id)
 
             if len(variants) > 5:
-                print(f"      ... 还有 {len(variants) - 5} 个变体")
+                log.debug("      ... 还有 %s 个变体", len(variants) - 5)
 
             # 添加到delete_variant_data
             if variant_ids:
                 delete_variant_data[str(country_id)] = variant_ids
 
-        print(f"\n   📊 delete_variant 参数:")
-        print(f"      {json.dumps(delete_variant_data, ensure_ascii=False)}")
+        log.debug("   📊 delete_variant 参数:")
+        log.debug("      %s", LazyJson(delete_variant_data))
     else:
-        print(f"✅ 所有国家都有报价数据，无需删除变体")
+        log.info("✅ 所有国家都有报价数据，无需删除变体")
 
     # ==================== 构建报价参数 ====================
 
     # 7. 构建报价参数
-    print(f"\n💰 开始构建报价参数...")
+    log.info("💰 开始构建报价参数...")
 
     quotation_payload = {
         "product_id": int(product_id),
@@ -1398,140 +3734,123 @@ def process_quotation_task(task_data):
     # ✅ 添加delete_variant参数（如果有缺失国家）
     if delete_variant_data:
         quotation_payload["delete_variant"] = delete_variant_data
-        print(f"   ✅ 已添加 delete_variant 参数")
-
-    price_params_count = 0
-    skipped_zero_price = 0
-    skipped_no_country = 0
-    country_code_conversions = {}
-
-    for quote in quotation_result:
-        original_nation = quote.get('nation')
-        quantity = quote.get('quantity')
-        price = quote.get('price')
-
-        if not original_nation or quantity is None or price is None:
-            continue
-
-        if price == 0:
-            skipped_zero_price += 1
-            continue
-
-        nation = normalize_country_code(original_nation)
-
-        if original_nation != nation:
-            if original_nation not in country_code_conversions:
-                country_code_conversions[original_nation] = nation
+        log.info("   ✅ 已添加 delete_variant 参数")
 
-        country_id = country_mapping.get(nation)
-        variants = country_variants.get(nation)
+    price_params, price_params_count, skipped_no_country, preview = compiled_quotation.price_params(
+        country_mapping, country_variants)
+    quotation_payload.update(price_params)
+    skipped_zero_price = compiled_quotation.skipped_zero_price
+    country_code_conversions = compiled_quotation.country_code_conversions
 
-        if not country_id or not variants:
-            skipped_no_country += 1
-            continue
-
-        for variant in variants:
-            variant_id = variant.get('variant_id')
-            if not variant_id:
-                continue
-
-            calculated_price = round(price * 0.99, 2)
-            param_name = f"pcs_{quantity}_{variant_id}_{country_id}"
-            quotation_payload[param_name] = str(calculated_price)
-
-            price_params_count += 1
-            if price_params_count <= 15:
-                print(f"   ✅ {param_name} = {calculated_price} (原价: {price})")
+    for param_name, calculated_price, price in preview:
+        log.debug("   ✅ %s = %s (原价: %s)", param_name, calculated_price, price)
 
     if price_params_count > 15:
-        print(f"   ... 还有 {price_params_count - 15} 个价格参数未显示")
+        log.debug("   ... 还有 %s 个价格参数未显示", price_params_count - 15)
 
     if country_code_conversions:
-        print(f"\n   ℹ️  国家代码转换:")
+        log.info("   ℹ️  国家代码转换:")
         for original, converted in country_code_conversions.items():
-            print(f"      {original} -> {converted}")
+            log.info("      %s -> %s", original, converted)
 
     if skipped_zero_price > 0:
-        print(f"\n   ⚠️  跳过价格为0的报价: {skipped_zero_price} 条")
+        log.warning("   ⚠️  跳过价格为0的报价: %s 条", skipped_zero_price)
     if skipped_no_country > 0:
-        print(f"   ⚠️  跳过未找到country_id的报价: {skipped_no_country} 条")
+        log.warning("   ⚠️  跳过未找到country_id的报价: %s 条", skipped_no_country)
 
     if price_params_count == 0:
-        print(f"\n❌ 错误: 未能生成任何价格参数")
-        save_task_status(
-            keer_product_id=keer_product_id,
+        log.error("❌ 错误: 未能生成任何价格参数")
+        status.save(
             quotation_feedback_status=2
         )
         return False
 
-    print(f"\n📤 报价参数构建完成，共 {price_params_count} 个有效价格")
+    log.info("📤 报价参数构建完成，共 %s 个有效价格", price_params_count)
 
-    # 8. 提交报价（包含delete_variant）
-    print(f"\n🚀 正在提交报价...")
-    if delete_variant_data:
-        print(f"   ℹ️  同时删除 {len(delete_variant_data)} 个国家的变体")
+    # 8. 提交报价（包含delete_variant）；SP上已是相同报价时跳过
+    submit_mode, submit_payload = plan_quotation_submission(
+        quotation_payload, price_params, delete_variant_data, product_detail, country_mapping)
 
-    update_result = update_product_quotation(SP_API_KEY, quotation_payload)
+    if submit_mode == "skipped":
+        log.info("✅ SP上已是相同的报价，跳过提交")
+        update_result = None
+    else:
+        log.info("🚀 正在提交报价...")
+        if delete_variant_data:
+            log.info("   ℹ️  同时删除 %s 个国家的变体", len(delete_variant_data))
 
-    if not update_result or not update_result.get('success'):
-        print(f"\n❌ 报价提交失败!")
-        print(f"响应: {update_result}")
-        save_task_status(
-            keer_product_id=keer_product_id,
-            quotation_feedback_status=2
-        )
-        return False
+        update_result = update_product_quotation(SP_API_KEY, submit_payload)
+
+        if not update_result or not update_result.get('success'):
+            log.error("❌ 报价提交失败!")
+            log.error("响应: %s", LogTruncated(update_result))
+            status.save(
+                quotation_feedback_status=2
+            )
+            return False
 
-    print(f"\n✅✅✅ 报价提交成功! ✅✅✅")
-    print(f"响应: {update_result.get('data')}")
+        log.info("✅✅✅ 报价提交成功! ✅✅✅")
+        log.debug("响应: %s", update_result.get('data'))
 
-    if delete_variant_data:
-        print(f"✅ 缺失国家的变体已成功删除!")
+        if delete_variant_data:
+            log.info("✅ 缺失国家的变体已成功删除!")
+
+    count_quotation_submission(submit_mode)
 
     # ==================== 报价成功，继续处理消息和图片 ====================
 
-    # 9. 重新获取产品详情以获得quotation_id
-    print(f"\n📋 重新获取产品详情以获得quotation_id...")
-    detail_result_2 = get_product_quotation(SP_API_KEY, product_id, is_attachment_needed=1)
+    # 9. 获取quotation_id（优先复用提交响应/首次详情，缺失时轻量重新获取）
+    log.info("📋 获取quotation_id...")
+    message_ids = resolve_message_ids(SP_API_KEY, product_id, update_result, product_detail)
 
-    if not detail_result_2 or not detail_result_2.get('success'):
-        print(f"❌ 重新获取产品详情失败")
-        save_task_status(
-            keer_product_id=keer_product_id,
+    if not message_ids:
+        log.error("❌ 重新获取产品详情失败")
+        status.save(
             quotation_feedback_status=3
         )
         return False
 
-    product_detail_2 = detail_result_2.get('data', [])[0]
-    quotation_id = product_detail_2.get('quotation_id')
-    client_account_id = product_detail_2.get('client_account_id')
-    client_user_id = product_detail_2.get('client_user_id')
-    quotation_request_id = product_detail_2.get('quotation_request_id')
+    quotation_id = message_ids['quotation_id']
+    client_account_id = message_ids['client_account_id']
+    client_user_id = message_ids['client_user_id']
+    quotation_request_id = message_ids['quotation_request_id']
+    ctx['message_ids'] = message_ids
+
+    log.info("✅ 获取到quotation_id: %s", quotation_id)
+    log.debug("   client_account_id: %s", client_account_id)
+    log.debug("   client_user_id: %s", client_user_id)
+    log.debug("   quotation_request_id: %s", quotation_request_id)
+    return True
+
 
-    print(f"✅ 获取到quotation_id: {quotation_id}")
-    print(f"   client_account_id: {client_account_id}")
-    print(f"   client_user_id: {client_user_id}")
-    print(f"   quotation_request_id: {quotation_request_id}")
+def quotation_prefetch_stage(ctx):
+    """
+    报价任务阶段：获取消息内容和待上传图片，并下载编码图片
+    在报价提交成功后执行，失败的任务不下载图片
+    """
+    keer_product_id = ctx['task_data'].get('keer_product_id')
+    if not keer_product_id:
+        return True
 
     # 10. 获取消息内容
-    print(f"\n📝 获取消息内容...")
+    log.info("📝 获取消息内容...")
     message_content = get_message_content(keer_product_id)
-    print(f"   消息内容: {message_content[:100]}...")
+    log.debug("   消息内容: %s...", message_content[:100])
 
     # 11. 获取待上传图片
-    print(f"\n📸 获取待上传图片...")
+    log.info("📸 获取待上传图片...")
     old_images_str = get_uploaded_images(keer_product_id)
     all_images_str = get_all_product_images(keer_product_id)
 
-    print(f"   已上传图片: {old_images_str[:100] if old_images_str else '无'}")
-    print(f"   所有实拍图: {all_images_str[:150] if all_images_str else '无'}")
+    log.debug("   已上传图片: %s", old_images_str[:100] if old_images_str else '无')
+    log.debug("   所有实拍图: %s", all_images_str[:150] if all_images_str else '无')
 
     new_images_list = calculate_new_images(all_images_str, old_images_str)
 
     if new_images_list:
-        print(f"   ✅ 找到 {len(new_images_list)} 张待上传图片")
+        log.info("   ✅ 找到 %s 张待上传图片", len(new_images_list))
     else:
-        print(f"   ℹ️  没有新图片需要上传")
+        log.info("   ℹ️  没有新图片需要上传")
 
     # 12. 下载并编码图片
     image_files = []
@@ -1539,38 +3858,66 @@ def process_quotation_task(task_data):
     failed_images = []
 
     if new_images_list:
-        print(f"\n📥 开始下载图片...")
-        for i, img_url in enumerate(new_images_list, 1):
-            encoded_image = download_and_encode_image(img_url, i)
+        log.info("📥 开始并行下载图片 (线程数: %s)...", min(IMAGE_DOWNLOAD_WORKERS, len(new_images_list)))
+        encoded_results = download_images_parallel(new_images_list)
+        for i, (img_url, encoded_image) in enumerate(zip(new_images_list, encoded_results), 1):
             if encoded_image:
                 image_files.append(encoded_image)
                 successfully_downloaded_images.append(img_url)
             else:
                 failed_images.append(img_url)
-                print(f"      ⚠️  图片 {i} 处理失败，跳过该图片")
+                log.warning("      ⚠️  图片 %s 处理失败，跳过该图片", i)
 
         # 统计结果
-        print(f"\n   📊 图片处理结果:")
-        print(f"      ✅ 成功: {len(successfully_downloaded_images)}/{len(new_images_list)} 张")
+        log.info("   📊 图片处理结果:")
+        log.info("      ✅ 成功: %s/%s 张", len(successfully_downloaded_images), len(new_images_list))
         if failed_images:
-            print(f"      ❌ 失败: {len(failed_images)} 张")
+            log.warning("      ❌ 失败: %s 张", len(failed_images))
             for failed_url in failed_images:
-                print(f"         - {failed_url[:80]}...")
-
-        # 只有所有图片都失败才整体失败
-        if len(image_files) == 0 and len(new_images_list) > 0:
-            print(f"\n      ❌ 所有图片处理失败 - 整体失败")
-            save_task_status(
-                keer_product_id=keer_product_id,
-                quotation_feedback_status=3
-            )
-            return False
+                log.debug("         - %s...", failed_url[:80])
+
+    ctx.update(
+        message_content=message_content,
+        old_images_str=old_images_str,
+        new_images_list=new_images_list,
+        image_files=image_files,
+        successfully_downloaded_images=successfully_downloaded_images
+    )
+    return True
+
+
+def quotation_upload_stage(ctx):
+    """
+    报价任务阶段：发送消息和图片，更新已上传图片记录，保存最终状态
+    """
+    task_data = ctx['task_data']
+    status = ctx['status']
+    product_id = ctx['product_id']
+    shopify_product_id = ctx['shopify_product_id']
+    sp_status_message = ctx['sp_status_message']
+    message_content = ctx['message_content']
+    old_images_str = ctx['old_images_str']
+    new_images_list = ctx['new_images_list']
+    image_files = ctx['image_files']
+    successfully_downloaded_images = ctx['successfully_downloaded_images']
+    quotation_id = ctx['message_ids']['quotation_id']
+    client_account_id = ctx['message_ids']['client_account_id']
+    client_user_id = ctx['message_ids']['client_user_id']
+    quotation_request_id = ctx['message_ids']['quotation_request_id']
+
+    # 只有所有图片都失败才整体失败
+    if new_images_list and not image_files:
+        log.error("      ❌ 所有图片处理失败 - 整体失败")
+        status.save(
+            quotation_feedback_status=3
+        )
+        return False
 
     # 13. 发送消息和图片
-    print(f"\n📤 发送消息和图片到Service Points...")
+    log.info("📤 发送消息和图片到Service Points...")
 
     if image_files:
-        print(f"   准备发送 {len(image_files)} 张图片")
+        log.info("   准备发送 %s 张图片", len(image_files))
 
     message_data = {
         'product_id': int(product_id),
@@ -1585,19 +3932,18 @@ def process_quotation_task(task_data):
     send_result = send_product_message(SP_API_KEY, message_data, image_files if image_files else None)
 
     if not send_result or not send_result.get('success'):
-        print(f"❌ 发送消息失败: {send_result}")
-        print(f"⚠️  不更新shi_image_note")
-        save_task_status(
-            keer_product_id=keer_product_id,
+        log.error("❌ 发送消息失败: %s", send_result)
+        log.warning("⚠️  不更新shi_image_note")
+        status.save(
             quotation_feedback_status=3
         )
         return False
 
-    print(f"✅ 消息和图片发送成功!")
+    log.info("✅ 消息和图片发送成功!")
 
     # 14. 更新已上传图片记录
     if successfully_downloaded_images:
-        print(f"\n📝 更新已上传图片记录...")
+        log.info("📝 更新已上传图片记录...")
 
         new_images_str = ','.join(successfully_downloaded_images)
         if old_images_str:
@@ -1605,185 +3951,419 @@ def process_quotation_task(task_data):
         else:
             updated_shi_image_note = new_images_str
 
-        print(f"   新上传: {len(successfully_downloaded_images)} 张")
-        print(f"   总计: {len(updated_shi_image_note.split(','))} 张")
-
-        update_success = save_task_status(
-            keer_product_id=keer_product_id,
-            shi_image_note=updated_shi_image_note
-        )
+        log.info("   新上传: %s 张", len(successfully_downloaded_images))
+        log.info("   总计: %s 张", len(updated_shi_image_note.split(',')))
 
-        if update_success:
-            print(f"✅ 图片记录更新成功")
-        else:
-            print(f"❌ 图片记录更新失败")
+        status.save(shi_image_note=updated_shi_image_note)
+        log.info("✅ 图片记录已合并到最终状态，任务结束时统一回写")
 
     # 15. 最终成功
-    print(f"\n📝 保存最终成功状态...")
+    log.info("📝 保存最终成功状态...")
     if sp_status_message:
-        save_task_status(
-            keer_product_id=keer_product_id,
+        status.save(
             sp_status=sp_status_message,
             quotation_feedback_status=1
         )
     else:
-        save_task_status(
-            keer_product_id=keer_product_id,
+        status.save(
             quotation_feedback_status=1
         )
 
-    # ✅ 16. 调用update_sp_status接口
-    update_sp_status(keer_product_id)
+    # ✅ 16. 调用update_sp_status接口（任务结束时统一回写）
+    status.mark_sp_completed()
+    record_task_completed('quotation', task_data)
 
-    print(f"\n🎉🎉🎉 任务处理完成! (quotation_feedback_status=1) 🎉🎉🎉")
+    log.info("🎉🎉🎉 任务处理完成! (quotation_feedback_status=1) 🎉🎉🎉")
     return True
 
 
-# ==================== 主程序 ====================
+# 顺序执行时的阶段顺序（与拆分前一致：报价提交成功后才下载图片）
+QUOTATION_STAGES = (
+    quotation_lookup_stage,
+    quotation_submit_stage,
+    quotation_prefetch_stage,
+    quotation_upload_stage,
+)
 
-def main():
+
+def process_quotation_task(task_data, status):
+    """
+    处理单个报价任务（依次执行 QUOTATION_STAGES）
     """
-    主程序入口 - 依次处理今天、昨天、前天的任务
-    处理顺序：今天全部任务 → 昨天全部任务 → 前天全部任务
+    ctx = {'task_data': task_data, 'status': status}
+    for stage in QUOTATION_STAGES:
+        if not stage(ctx):
+            return False
+    return True
 
-    返回值：
-    - True: 有任务被处理
-    - False: 没有任务
+
+# ==================== 内存统计 ====================
+
+def _peak_rss_bytes():
+    """
+    进程RSS峰值（字节），不支持的平台返回None
     """
-    print("=" * 100)
-    print("Service Points 自动报价系统")
-    print("=" * 100)
+    if resource is None:
+        return None
 
-    store_code = "SP00001"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return peak if sys.platform == 'darwin' else peak * 1024
 
-    # 获取需要处理的日期列表
-    date_list = get_date_list()
 
-    print(f"\n📅 处理顺序:")
-    print(f"   1. {date_list[0]} (今天)")
-    print(f"   2. {date_list[1]} (昨天)")
-    print(f"   3. {date_list[2]} (前天)")
+def _format_rss(rss_before, rss_after):
+    """
+    进程RSS峰值及任务期间的增长，不支持的平台返回 N/A
+    """
+    if rss_after is None:
+        return "N/A"
+    return f"{rss_after / 1024 / 1024:.1f} MB (任务期间增长 {(rss_after - rss_before) / 1024 / 1024:.1f} MB)"
 
-    # 统计总体结果
-    total_success = 0
-    total_fail = 0
-    total_tasks = 0
 
-    # 遍历每个日期
-    for date_index, created_at in enumerate(date_list, 1):
-        date_name = ["今天", "昨天", "前天"][date_index - 1]
+def run_task_with_memory_report(process_func, task_data, label=None):
+    """
+    执行任务并输出内存峰值（TRACK_TASK_MEMORY=False时直接执行）
+
+    - 任务逐个执行时：只在任务期间开启tracemalloc，结束后立即停止
+    - async模式多个任务并发：tracemalloc的峰值是全进程的，无法归属到单个任务，
+      只输出进程RSS峰值（同样是全进程数值）
+    """
+    if not TRACK_TASK_MEMORY:
+        return run_task_with_status(process_func, task_data, label)
+
+    rss_before = _peak_rss_bytes()
 
-        print(f"\n\n{'#' * 100}")
-        print(f"开始处理 {date_name} ({created_at}) 的任务")
-        print(f"{'#' * 100}")
+    if EXECUTION_MODE == "async":
+        try:
+            return run_task_with_status(process_func, task_data, label)
+        finally:
+            log.info("📈 进程RSS峰值: %s (并发执行，为全进程数值)", _format_rss(rss_before, _peak_rss_bytes()))
 
-        # 1. 获取两种任务
-        print("\n📥 获取待处理任务...")
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
 
-        # 获取报价任务
-        print("\n📋 获取报价任务...")
-        quotation_tasks_result = get_internal_tasks(store_code, created_at)
-        quotation_tasks = parse_task_data(quotation_tasks_result)
-        print(f"✅ 获取到 {len(quotation_tasks)} 个报价任务")
+    try:
+        return run_task_with_status(process_func, task_data, label)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        log.info("📈 任务内存峰值: %.1f MB (Python分配) | 进程RSS峰值: %s",
+                 peak / 1024 / 1024, _format_rss(rss_before, _peak_rss_bytes()))
 
-        # 获取标记不可报价任务
-        print("\n📋 获取标记不可报价任务...")
-        non_quotable_tasks_result = get_non_quotable_tasks(store_code, created_at)
-        non_quotable_tasks = parse_task_data(non_quotable_tasks_result)
-        print(f"✅ 获取到 {len(non_quotable_tasks)} 个标记不可报价任务")
 
-        # 统计当前日期任务数
-        date_total_tasks = len(quotation_tasks) + len(non_quotable_tasks)
-        total_tasks += date_total_tasks
+# ==================== 异步任务引擎 ====================
 
-        if date_total_tasks == 0:
-            print(f"\n⚠️  {date_name} ({created_at}) 没有待处理的任务，跳过")
-            continue
+async def _run_task_async(semaphore, executor, process_func, task, label):
+    """
+    在线程池中执行单个任务（任务内部仍是同步HTTP调用）
 
-        print(f"\n📊 {date_name} 任务统计:")
-        print(f"   报价任务: {len(quotation_tasks)} 个")
-        print(f"   标记不可报价任务: {len(non_quotable_tasks)} 个")
-        print(f"   总计: {date_total_tasks} 个")
+    返回: True / False（任务异常视为失败）
+    """
+    async with semaphore:
+        log.info('=' * 100)
+        log.info("%s 开始", label)
+        log.info('=' * 100)
 
-        # 2. 处理任务
-        date_success_count = 0
-        date_fail_count = 0
-        task_index = 0
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, run_task_with_memory_report, process_func, task, label)
+        except Exception as e:
+            log.error("❌ %s 处理异常: %s", label, e)
+            return False
 
-        # 先处理报价任务
-        for i, task in enumerate(quotation_tasks, 1):
-            task_index += 1
-            print(f"\n\n{'=' * 100}")
-            print(
-                f"[{date_name} {created_at}] 处理任务 {task_index}/{date_total_tasks} - 报价任务 {i}/{len(quotation_tasks)}")
-            print(f"{'=' * 100}")
 
-            result = process_quotation_task(task)
+async def process_tasks_async(jobs):
+    """
+    并发处理一批任务，最多同时处理 ASYNC_TASK_CONCURRENCY 个
 
-            if result:
-                date_success_count += 1
-                total_success += 1
-            else:
-                date_fail_count += 1
-                total_fail += 1
+    参数:
+        jobs: [(process_func, task_data, label), ...]
+
+    返回:
+        与jobs顺序一致的结果列表 [True/False, ...]
+    """
+    if not jobs:
+        return []
+
+    semaphore = asyncio.Semaphore(ASYNC_TASK_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=ASYNC_TASK_CONCURRENCY) as executor:
+        return await asyncio.gather(*[
+            _run_task_async(semaphore, executor, process_func, task, label)
+            for process_func, task, label in jobs
+        ])
+
+
+# ==================== 流水线任务引擎 ====================
+
+# pipeline模式下的阶段顺序与顺序执行相同：报价提交成功后才下载图片，查询或提交失败的任务不会下载图片
+# 报价任务 N 上传时，N+1 在下载消息和图片，N+2 在提交报价，N+3 在查询产品和详情
+QUOTATION_PIPELINE_STAGES = (
+    ("查询", quotation_lookup_stage),
+    ("提交", quotation_submit_stage),
+    ("图片", quotation_prefetch_stage),
+    ("上传", quotation_upload_stage),
+)
+
+
+class TaskPipeline:
+    """
+    分阶段流水线：每个阶段一个工作线程，阶段之间用有界队列连接
+
+    - 队列满时上游阶段阻塞，同时持有中间结果（如已下载的图片）的任务数有上限
+    - 某个阶段失败的任务直接传到末尾，不再执行后续阶段
+    - 每个任务完成时输出各阶段队列深度
+    """
+
+    def __init__(self, stages, queue_size):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.max_depths = [0] * len(stages)
+        self._depth_lock = threading.Lock()
+
+    def _put(self, index, ctx):
+        self.queues[index].put(ctx)
+        depth = self.queues[index].qsize()
+        with self._depth_lock:
+            self.max_depths[index] = max(self.max_depths[index], depth)
+
+    def depth_line(self):
+        """
+        各阶段输入队列的当前深度 / 容量（峰值）
+        """
+        return " | ".join(
+            f"{name}: {task_queue.qsize()}/{task_queue.maxsize} (峰值 {max_depth})"
+            for (name, _), task_queue, max_depth in zip(self.stages, self.queues, self.max_depths)
+        )
+
+    def _finish(self, ctx, results):
+        flush_task_statuses([ctx['status']])
+        success = not ctx.get('failed')
+        results[ctx['index']] = success
+        log.info("🏁 %s %s | 队列深度: %s", ctx['label'], '✅ 成功' if success else '❌ 失败', self.depth_line())
+        log_task_summary(ctx['task_data'], ctx['status'], success, time.perf_counter() - ctx['started'])
+
+    def _worker(self, index, results):
+        name, stage = self.stages[index]
+        is_last = index == len(self.stages) - 1
+
+        while True:
+            ctx = self.queues[index].get()
+            if ctx is None:
+                if not is_last:
+                    self._put(index + 1, None)
+                return
+
+            # 任何异常都不能让工作线程退出：否则上游在有界队列上的 put 会一直阻塞
+            set_log_task(ctx['label'])
+            try:
+                if not ctx.get('failed'):
+                    try:
+                        if not stage(ctx):
+                            ctx['failed'] = True
+                    except Exception as e:
+                        log.error("❌ %s %s阶段异常: %s", ctx['label'], name, e)
+                        ctx['failed'] = True
+
+                if is_last:
+                    self._finish(ctx, results)
+                else:
+                    self._put(index + 1, ctx)
+            except Exception as e:
+                log.error("❌ %s %s阶段结束处理异常: %s", ctx['label'], name, e)
+            finally:
+                set_log_task(None)
+
+    def run(self, items):
+        """
+        参数:
+            items: [(task_data, label), ...]
+
+        返回:
+            与items顺序一致的结果列表 [True/False, ...]
+        """
+        results = [False] * len(items)
+        workers = [
+            threading.Thread(target=self._worker, args=(index, results), name=f"pipeline-{name}", daemon=True)
+            for index, (name, _) in enumerate(self.stages)
+        ]
+        for worker in workers:
+            worker.start()
+
+        for index, (task, label) in enumerate(items):
+            self._put(0, {
+                'task_data': task,
+                'status': TaskStatus(task.get('keer_product_id')),
+                'label': label,
+                'index': index,
+                'started': time.perf_counter()
+            })
+        self._put(0, None)
+
+        for worker in workers:
+            worker.join()
+        return results
+
+
+# ==================== 主程序 ====================
+
+TASK_LIST_SOURCES = (
+    ('quotation', '报价任务', get_internal_tasks),
+    ('non_quotable', '标记不可报价任务', get_non_quotable_tasks),
+)
+
+
+def main():
+    """
+    主程序入口 - 处理最近 TASK_LOOKBACK_DAYS 天的任务
+    1. 本轮开始时并发获取所有任务列表（较早日期按 DAY_POLL_INTERVALS 降低查询频率）
+    2. 合并去重为一个待处理任务集合
+    3. 处理顺序：按日期 今天 → 昨天 → 前天 → ...，每天先报价任务，再标记不可报价任务
+
+    返回值：
+    (total_tasks, new_tasks)
+    - total_tasks: 本轮获取到的任务总数
+    - new_tasks: 其中之前未尝试过（或内容有变化）的任务数
+    """
+    log.info("=" * 100)
+    log.info("Service Points 自动报价系统")
+    log.info("=" * 100)
 
-            # 避免请求过快，添加延迟
-            if task_index < date_total_tasks:
-                print(f"\n⏳ 等待3秒后处理下一个任务...")
-                time.sleep(3)
+    store_code = "SP00001"
+
+    # 获取需要处理的日期列表
+    date_list = get_date_list()
 
-        # 再处理标记不可报价任务
-        for i, task in enumerate(non_quotable_tasks, 1):
-            task_index += 1
-            print(f"\n\n{'=' * 100}")
-            print(
-                f"[{date_name} {created_at}] 处理任务 {task_index}/{date_total_tasks} - 标记不可报价任务 {i}/{len(non_quotable_tasks)}")
-            print(f"{'=' * 100}")
+    log.info("📅 查询日期:")
+    for day_offset, created_at in enumerate(date_list):
+        log.info("   %s. %s (%s)", day_offset + 1, created_at, date_label(day_offset))
+
+    TASK_LIST_POLLER.retain(date_list)
+    prune_completion_ledger()
+
+    # 1. 并发获取所有任务列表
+    log.info("📥 并发获取任务列表...")
+    task_lists = fetch_all_task_lists(TASK_LIST_SOURCES, store_code, date_list)
+    total_tasks = sum(len(tasks) for tasks in task_lists.values())
+
+    # 2. 合并去重，跳过本地已完成的任务，只保留新任务和到期重试的任务
+    work_set = {}
+    task_dates = {}
+    total_new_tasks = 0
+    total_skipped_tasks = 0
+    total_waiting_tasks = 0
+    for task_type, task_name, _ in TASK_LIST_SOURCES:
+        tasks, task_dates[task_type], duplicates = merge_task_lists(task_type, task_lists, date_list)
+        tasks, skipped = filter_completed_tasks(task_type, tasks)
+        observed_count = len(tasks)
+        tasks, new_count = TASK_TRACKER.observe(task_type, tasks)
+
+        work_set[task_type] = tasks
+        total_new_tasks += new_count
+        total_skipped_tasks += skipped
+        total_waiting_tasks += observed_count - len(tasks)
+
+        log.info("📊 %s: 待处理 %s 个 (新任务: %s 个, 到期重试: %s 个, 未到重试时间: %s 个, 本地已完成: %s 个, 跨日期重复: %s 个)",
+                 task_name, len(tasks), new_count, len(tasks) - new_count, observed_count - len(tasks), skipped, duplicates)
+
+    quotation_tasks = work_set['quotation']
+    non_quotable_tasks = work_set['non_quotable']
+    work_total = len(quotation_tasks) + len(non_quotable_tasks)
+
+    # 按日期排列：今天的报价任务 → 今天的标记不可报价任务 → 昨天的报价任务 → ...
+    # 今天的标记不可报价任务（处理很快）不用等较早日期的报价任务
+    jobs_by_day = {created_at: [] for created_at in date_list}
+    for task_type, process_func, task_name in (
+        ('quotation', process_quotation_task, "报价任务"),
+        ('non_quotable', process_non_quotable_task, "标记不可报价任务"),
+    ):
+        tasks = work_set[task_type]
+        for i, task in enumerate(tasks, 1):
+            created_at = task_dates[task_type][str(task.get('keer_product_id'))]
+            label = f"[{date_label(date_list.index(created_at))} {created_at}] {task_name} {i}/{len(tasks)}"
+            jobs_by_day[created_at].append((process_func, task, label))
+    jobs = [job for created_at in date_list for job in jobs_by_day[created_at]]
+
+    # 3. 处理任务
+    total_success = 0
+    total_fail = 0
+
+    if work_total == 0:
+        log.warning("⚠️  没有待处理的任务")
+    elif EXECUTION_MODE == "async":
+        # 并发处理：报价任务和标记不可报价任务一起提交（按上面的日期顺序开始）
+        log.info("⚡ 并发处理 %s 个任务 (并发数: %s)", work_total, ASYNC_TASK_CONCURRENCY)
+        results = asyncio.run(process_tasks_async(jobs))
+        total_success = sum(1 for result in results if result)
+        total_fail = len(results) - total_success
+    elif EXECUTION_MODE == "pipeline":
+        # 逐日处理：当天的报价任务分阶段流水线处理，随后逐个处理当天的标记不可报价任务
+        log.info("🔀 流水线处理 %s 个报价任务 (阶段: %s, 队列容量: %s)",
+                 len(quotation_tasks), ' → '.join(name for name, _ in QUOTATION_PIPELINE_STAGES), PIPELINE_QUEUE_SIZE)
+        pipeline = TaskPipeline(QUOTATION_PIPELINE_STAGES, PIPELINE_QUEUE_SIZE)
+        results = []
+        for created_at in date_list:
+            day_jobs = jobs_by_day[created_at]
+            pipeline_items = [(task, label) for process_func, task, label in day_jobs
+                              if process_func is process_quotation_task]
+            if pipeline_items:
+                results.extend(pipeline.run(pipeline_items))
+
+            for process_func, task, label in day_jobs:
+                if process_func is process_quotation_task:
+                    continue
+                log.info('=' * 100)
+                log.info("%s", label)
+                log.info('=' * 100)
+                results.append(run_task_with_memory_report(process_func, task, label))
+        log.info("📊 流水线队列: %s", pipeline.depth_line())
+
+        total_success = sum(1 for result in results if result)
+        total_fail = len(results) - total_success
+    else:
+        for task_index, (process_func, task, label) in enumerate(jobs, 1):
+            label = f"{label} (处理任务 {task_index}/{work_total})"
+            log.info('=' * 100)
+            log.info("%s", label)
+            log.info('=' * 100)
 
-            result = process_non_quotable_task(task)
+            result = run_task_with_memory_report(process_func, task, label)
 
             if result:
-                date_success_count += 1
                 total_success += 1
             else:
-                date_fail_count += 1
                 total_fail += 1
 
-            # 避免请求过快，添加延迟
-            if task_index < date_total_tasks:
-                print(f"\n⏳ 等待3秒后处理下一个任务...")
-                time.sleep(3)
-
-        # 3. 输出当前日期统计结果
-        print(f"\n\n{'=' * 100}")
-        print(f"{date_name} ({created_at}) 处理完成 - 统计结果")
-        print(f"{'=' * 100}")
-        print(f"总任务数: {date_total_tasks}")
-        print(f"   报价任务: {len(quotation_tasks)}")
-        print(f"   标记不可报价任务: {len(non_quotable_tasks)}")
-        print(f"✅ 成功: {date_success_count}")
-        print(f"❌ 失败: {date_fail_count}")
-        if date_total_tasks > 0:
-            print(f"成功率: {date_success_count / date_total_tasks * 100:.1f}%")
-        print(f"{'=' * 100}")
-
     # 4. 输出总体统计结果
-    print(f"\n\n{'#' * 100}")
-    print("所有日期处理完成 - 总体统计")
-    print(f"{'#' * 100}")
-    print(f"处理日期:")
-    print(f"   1. {date_list[0]} (今天)")
-    print(f"   2. {date_list[1]} (昨天)")
-    print(f"   3. {date_list[2]} (前天)")
-    print(f"\n总任务数: {total_tasks}")
-    print(f"✅ 总成功: {total_success}")
-    print(f"❌ 总失败: {total_fail}")
-    if total_tasks > 0:
-        print(f"总成功率: {total_success / total_tasks * 100:.1f}%")
-    print(f"{'#' * 100}")
-
-    # 返回是否有任务被处理
-    return total_tasks > 0
+    log.info('#' * 100)
+    log.info("本轮处理完成 - 总体统计")
+    log.info('#' * 100)
+    log.info("处理日期:")
+    for day_offset, created_at in enumerate(date_list):
+        log.info("   %s. %s (%s)", day_offset + 1, created_at, date_label(day_offset))
+    log.info("获取任务数: %s (新任务: %s, 跳过本地已完成: %s, 未到重试时间: %s)",
+             total_tasks, total_new_tasks, total_skipped_tasks, total_waiting_tasks)
+    log.info("处理任务数: %s", work_total)
+    log.info("   报价任务: %s", len(quotation_tasks))
+    log.info("   标记不可报价任务: %s", len(non_quotable_tasks))
+    log.info("✅ 总成功: %s", total_success)
+    log.info("❌ 总失败: %s", total_fail)
+    if work_total > 0:
+        log.info("总成功率: %.1f%%", total_success / work_total * 100)
+    print_image_encode_stats()
+    print_quotation_id_stats()
+    print_quotation_submit_stats()
+    print_cache_stats()
+    log.info("📮 %s", STATUS_OUTBOX.stats_line())
+    log.info('#' * 100)
+    log.log(SUMMARY, "本轮汇总: 获取 %s (新任务 %s) | 处理 %s | 成功 %s | 失败 %s",
+            total_tasks, total_new_tasks, work_total, total_success, total_fail)
+
+    TASK_TRACKER.end_round()
+
+    return total_tasks, total_new_tasks
 
 
 def run_loop():
@@ -1791,67 +4371,84 @@ def run_loop():
     无限循环执行主程序
 
     执行逻辑：
-    1. 完成今天的所有任务（报价任务 + 不可报价标记任务）
-    2. 完成昨天的所有任务（报价任务 + 不可报价标记任务）
-    3. 完成前天的所有任务（报价任务 + 不可报价标记任务）
-    4. 如果有任务被处理，立即开始下一轮
-    5. 如果没有任务，等待30秒后再开始下一轮
+    1. 并发获取最近 TASK_LOOKBACK_DAYS 天的报价任务和不可报价标记任务（较早日期按 DAY_POLL_INTERVALS 降低查询频率）
+    2. 合并去重后按日期处理：今天的报价任务 → 今天的标记不可报价任务 → 昨天的 → ...
+    3. 每天内先处理报价任务，再处理标记不可报价任务
+    4. 如果有新任务，等待 POLL_BUSY_INTERVAL 秒（默认立即）开始下一轮
+    5. 如果没有任务，或返回的任务都已尝试过，从 LOOP_INTERVAL 秒开始按倍数退避，最多 POLL_MAX_INTERVAL 秒
     """
     loop_count = 0
+    poll_interval = POLL_BUSY_INTERVAL
 
-    print("\n" + "🔄" * 50)
-    print("启动无限循环模式")
-    print(f"执行顺序: 今天全部任务 → 昨天全部任务 → 前天全部任务")
-    print(f"有任务: 立即开始下一轮 | 无任务: 等待{LOOP_INTERVAL}秒")
-    print("按 Ctrl+C 停止程序")
-    print("🔄" * 50 + "\n")
+    log.info("🔄" * 50)
+    log.info("启动无限循环模式")
+    log.info("执行顺序: 并发获取最近 %s 天的任务列表 → 按日期（今天优先）处理报价任务 → 标记不可报价任务", TASK_LOOKBACK_DAYS)
+    log.info("列表查询间隔: %s", " | ".join(
+        f"{date_label(day_offset)} {day_poll_interval(day_offset)}秒" for day_offset in range(TASK_LOOKBACK_DAYS)))
+    log.info("有新任务: 等待%s秒 | 无新任务: 等待%s秒起，逐轮翻倍，最多%s秒", POLL_BUSY_INTERVAL, LOOP_INTERVAL, POLL_MAX_INTERVAL)
+    log.info("按 Ctrl+C 停止程序")
+    log.info("🔄" * 50)
+
+    # 回写上次运行遗留的任务状态
+    STATUS_OUTBOX.start()
 
     while True:
         try:
             loop_count += 1
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            print(f"\n\n{'🔄' * 50}")
-            print(f"第 {loop_count} 轮循环开始")
-            print(f"当前时间: {current_time}")
-            print(f"{'🔄' * 50}\n")
-
-            # 执行主程序（会依次处理今天、昨天、前天）
-            has_tasks = main()
-
-            # 根据是否有任务决定等待策略
-            if has_tasks:
-                # 有任务 - 立即开始下一轮
-                print(f"\n\n{'⚡' * 50}")
-                print(f"第 {loop_count} 轮循环完成")
-                print(f"✅ 有任务被处理，立即开始下一轮")
-                print(f"{'⚡' * 50}\n")
-                # 不等待，直接继续下一轮
+            log.info('🔄' * 50)
+            log.info("第 %s 轮循环开始", loop_count)
+            log.info("当前时间: %s", current_time)
+            log.info('🔄' * 50)
+
+            # 执行主程序（会依次处理最近 TASK_LOOKBACK_DAYS 天）
+            total_tasks, new_tasks = main()
+
+            # 根据是否有新任务决定等待策略
+            poll_interval = next_poll_interval(poll_interval, new_tasks)
+
+            if new_tasks > 0:
+                # 有新任务 - 快速开始下一轮
+                log.info('⚡' * 50)
+                log.info("第 %s 轮循环完成", loop_count)
+                log.info("✅ 有 %s 个新任务被处理，%s 秒后开始下一轮", new_tasks, poll_interval)
+                log.info('⚡' * 50)
             else:
-                # 没有任务 - 等待30秒
-                next_time = (datetime.now() + timedelta(seconds=LOOP_INTERVAL)).strftime("%Y-%m-%d %H:%M:%S")
-                print(f"\n\n{'⏰' * 50}")
-                print(f"第 {loop_count} 轮循环完成")
-                print(f"ℹ️  没有任务需要处理，等待 {LOOP_INTERVAL} 秒")
-                print(f"下一轮开始时间: {next_time}")
-                print(f"{'⏰' * 50}\n")
-                time.sleep(LOOP_INTERVAL)
+                # 没有新任务 - 退避等待
+                next_time = (datetime.now() + timedelta(seconds=poll_interval)).strftime("%Y-%m-%d %H:%M:%S")
+                log.info('⏰' * 50)
+                log.info("第 %s 轮循环完成", loop_count)
+                if total_tasks > 0:
+                    log.info("ℹ️  %s 个任务都已尝试过，没有新任务，等待 %s 秒", total_tasks, poll_interval)
+                else:
+                    log.info("ℹ️  没有任务需要处理，等待 %s 秒", poll_interval)
+                log.info("下一轮开始时间: %s", next_time)
+                log.info('⏰' * 50)
+
+            if poll_interval > 0:
+                time.sleep(poll_interval)
 
         except KeyboardInterrupt:
-            print(f"\n\n{'🛑' * 50}")
-            print("接收到停止信号")
-            print(f"程序已运行 {loop_count} 轮循环")
-            print("程序已安全退出")
-            print(f"{'🛑' * 50}\n")
+            log.info('🛑' * 50)
+            log.info("接收到停止信号")
+            log.info("程序已运行 %s 轮循环", loop_count)
+            STATUS_OUTBOX.stop()
+            log.info("📮 %s", STATUS_OUTBOX.stats_line())
+            close_http_sessions()
+            log.info("程序已安全退出")
+            log.info('🛑' * 50)
+            stop_logging()
             break
         except Exception as e:
-            print(f"\n\n{'❌' * 50}")
-            print(f"第 {loop_count} 轮循环发生错误: {e}")
-            print("5秒后继续下一轮...")
-            print(f"{'❌' * 50}\n")
+            log.error('❌' * 50)
+            log.error("第 %s 轮循环发生错误: %s", loop_count, e)
+            log.warning("5秒后继续下一轮...")
+            log.error('❌' * 50)
             time.sleep(5)
 
 
 if __name__ == "__main__":
+    setup_logging()
     # 启动无限循环
     run_loop()
\ No newline at end of file
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准脚本
+
+用法: python benchmarks.py [基准名称 ...]
+不带参数时运行全部基准；每个基准同时校验新旧实现结果一致
+"""
+
+import base64
+import contextlib
+import io
+import json
+import logging
+import random
+import sys
+import time
+
+import V1
+
+# 基准测试时不输出 V1 的日志（未调用 setup_logging 时警告会输出到stderr）
+V1.log.addHandler(logging.NullHandler())
+V1.log.propagate = False
+
+
+def _timeit(func, repeat=5):
+    """返回多次运行中的最短耗时（秒）"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# ==================== 店铺匹配 ====================
+
+def legacy_match_product_by_store(products, store_code):
+    """优化前的 match_product_by_store（逐个候选拼接组合代码并打印）"""
+    if not products or not store_code:
+        return None
+
+    print(f"\n🔍 开始匹配店铺编码: {store_code}")
+    for product in products:
+        supplier_detail = product.get('supplier_detail', {})
+        supplier_name = supplier_detail.get('name', '') if isinstance(supplier_detail, dict) else ''
+        product_store = product.get('store', '')
+
+        if supplier_name and supplier_name in V1.SUPPLIER_NAME_TO_CODE:
+            code_prefix = V1.SUPPLIER_NAME_TO_CODE[supplier_name]
+            combined_store_code = f"{code_prefix}-{product_store}"
+
+            print(f"   🔍 产品: {product.get('product_id')}")
+            print(f"      报价人员: {supplier_name}")
+            print(f"      代码前缀: {code_prefix}")
+            print(f"      产品店铺: {product_store}")
+            print(f"      组合代码: {combined_store_code}")
+
+            if combined_store_code == store_code:
+                print("   ✅ 完全匹配!")
+                return product
+
+            if store_code.startswith(combined_store_code):
+                print("   ✅ 前缀匹配!")
+                return product
+
+    print("   ⚠️  未通过报价人员匹配到产品，尝试传统匹配...")
+
+    store_parts = store_code.split('-')
+    matched_products = []
+
+    for product in products:
+        product_store = product.get('store', '')
+
+        if store_code == product_store:
+            print(f"   ✅ 完全匹配: {product_store}")
+            return product
+
+        is_match = False
+        for part in store_parts:
+            if part and len(part) > 3 and part in product_store:
+                is_match = True
+                break
+
+        if is_match:
+            matched_products.append(product)
+            print(f"   ✓ 部分匹配: {product_store}")
+
+    if matched_products:
+        print("   → 使用第一个匹配的产品")
+        return matched_products[0]
+
+    print("   ⚠️  未找到匹配的店铺，使用第一个产品")
+    return products[0] if products else None
+
+
+def _random_store(rng):
+    return f"{rng.choice('abcdefghijklmnopqrstuvwxyz')}{rng.randrange(16**5):05x}-v{rng.randrange(3)}"
+
+
+def _make_store_case(rng, size):
+    """生成 size 个候选产品及一个 store_code（目标随机落在末尾附近、中间或不存在）"""
+    supplier_names = list(V1.SUPPLIER_NAME_TO_CODE) + ["Unknown Person", ""]
+    products = []
+    for index in range(size):
+        products.append({
+            "product_id": f"P{index}",
+            "store": _random_store(rng),
+            "supplier_detail": {"name": rng.choice(supplier_names)},
+        })
+
+    target = rng.choice(products)
+    kind = rng.randrange(4)
+    target_name = target["supplier_detail"]["name"]
+    if kind == 0 and target_name in V1.SUPPLIER_NAME_TO_CODE:
+        store_code = f"{V1.SUPPLIER_NAME_TO_CODE[target_name]}-{target['store']}"
+    elif kind == 1 and target_name in V1.SUPPLIER_NAME_TO_CODE:
+        store_code = f"{V1.SUPPLIER_NAME_TO_CODE[target_name]}-{target['store']}-extra"
+    elif kind == 2:
+        store_code = f"XX-{target['store']}"
+    else:
+        store_code = f"SQQ-SP99999-{_random_store(rng)}"
+    return products, store_code
+
+
+def bench_store_match():
+    """match_product_by_store: 新旧实现在 100/300/1000 个候选产品下的耗时对比"""
+    rng = random.Random(14)
+    sink = io.StringIO()
+
+    for size in (100, 300, 1000):
+        cases = [_make_store_case(rng, size) for _ in range(50)]
+
+        with contextlib.redirect_stdout(sink):
+            for products, store_code in cases:
+                expected = legacy_match_product_by_store(products, store_code)
+                actual = V1.match_product_by_store(products, store_code)
+                assert actual is expected, (store_code, expected, actual)
+
+            legacy_time = _timeit(lambda: [legacy_match_product_by_store(p, s) for p, s in cases])
+            new_time = _timeit(lambda: [V1.match_product_by_store(p, s) for p, s in cases])
+        sink.seek(0)
+        sink.truncate()
+
+        print(f"store_match 候选 {size:>5}: 旧 {legacy_time * 1000:8.2f}ms  "
+              f"新 {new_time * 1000:8.2f}ms  加速 {legacy_time / new_time:5.1f}x")
+
+
+# ==================== 报价参数编译 ====================
+
+def legacy_build_price_params(quotation_result, country_mapping, country_variants):
+    """优化前 process_quotation_task 中的多次遍历 + 逐个变体赋值"""
+    valid_quotes = [q for q in quotation_result if q.get('price', 0) > 0]
+    zero_price_quotes = [q for q in quotation_result if q.get('price', 0) == 0]
+
+    countries_with_quotes = set()
+    for quote in quotation_result:
+        original_nation = quote.get('nation')
+        if original_nation and quote.get('price', 0) > 0:
+            countries_with_quotes.add(_legacy_normalize_country_code(original_nation))
+
+    payload = {}
+    price_params_count = 0
+    skipped_zero_price = 0
+    skipped_no_country = 0
+    country_code_conversions = {}
+
+    for quote in quotation_result:
+        original_nation = quote.get('nation')
+        quantity = quote.get('quantity')
+        price = quote.get('price')
+
+        if not original_nation or quantity is None or price is None:
+            continue
+
+        if price == 0:
+            skipped_zero_price += 1
+            continue
+
+        nation = _legacy_normalize_country_code(original_nation)
+
+        if original_nation != nation:
+            if original_nation not in country_code_conversions:
+                country_code_conversions[original_nation] = nation
+
+        country_id = country_mapping.get(nation)
+        variants = country_variants.get(nation)
+
+        if not country_id or not variants:
+            skipped_no_country += 1
+            continue
+
+        for variant in variants:
+            variant_id = variant.get('variant_id')
+            if not variant_id:
+                continue
+
+            calculated_price = round(price * 0.99, 2)
+            param_name = f"pcs_{quantity}_{variant_id}_{country_id}"
+            payload[param_name] = str(calculated_price)
+            price_params_count += 1
+
+    return (len(valid_quotes), len(zero_price_quotes), countries_with_quotes, list(payload.items()),
+            price_params_count, skipped_zero_price, skipped_no_country, country_code_conversions)
+
+
+def _legacy_normalize_country_code(country_code):
+    """未加缓存的 normalize_country_code"""
+    if not country_code:
+        return country_code
+    country_code = country_code.strip().upper()
+    return V1.COUNTRY_CODE_MAPPING.get(country_code, country_code)
+
+
+def compiled_build_price_params(quotation_result, country_mapping, country_variants):
+    """CompiledQuotation 版本，返回值与 legacy_build_price_params 相同"""
+    compiled = V1.CompiledQuotation(quotation_result)
+    params, params_count, skipped_no_country, _ = compiled.price_params(country_mapping, country_variants)
+    return (compiled.valid_count, compiled.zero_count, compiled.countries_with_quotes, list(params.items()),
+            params_count, compiled.skipped_zero_price, skipped_no_country, compiled.country_code_conversions)
+
+
+def _make_quotation_case(rng, quote_count, variants_per_country):
+    """生成报价结果和产品变体（含价格为0、缺失国家、国家代码别名、重复报价）"""
+    nations = ["US", "us ", "UK/GB", "GB", "DE", "FR", "CA", "AU", "XX"]
+    country_mapping = {"US": 1, "GB": 2, "DE": 3, "FR": 4, "CA": 5, "AU": 6}
+    country_variants = {
+        nation: [{"variant_id": 10000 + index * 7 + offset} for index in range(variants_per_country)]
+        + [{"variant_id": None}]
+        for offset, nation in enumerate(country_mapping)
+    }
+    quotation_result = []
+    for _ in range(quote_count):
+        quotation_result.append({
+            "nation": rng.choice(nations),
+            "quantity": rng.choice([1, 2, 3, 5, 10]),
+            "price": rng.choice([0, 0.5, 1.99, 2.345, 12.5, rng.uniform(0.1, 50)]),
+            "profit": 1,
+        })
+    return quotation_result, country_mapping, country_variants
+
+
+def bench_quotation_compile():
+    """报价参数构建: 多次遍历逐个赋值 vs CompiledQuotation（1万以上价格参数）"""
+    rng = random.Random(22)
+
+    for quote_count, variants_per_country in ((20, 500), (60, 1000), (200, 2000)):
+        quotation_result, country_mapping, country_variants = _make_quotation_case(
+            rng, quote_count, variants_per_country)
+
+        expected = legacy_build_price_params(quotation_result, country_mapping, country_variants)
+        actual = compiled_build_price_params(quotation_result, country_mapping, country_variants)
+        assert actual == expected, "CompiledQuotation 结果与原实现不一致"
+
+        legacy_time = _timeit(lambda: legacy_build_price_params(quotation_result, country_mapping, country_variants))
+        new_time = _timeit(lambda: compiled_build_price_params(quotation_result, country_mapping, country_variants))
+
+        print(f"quotation_compile 报价 {quote_count:>4} × 变体 {variants_per_country:>5} "
+              f"({expected[4]:>7} 个参数): 旧 {legacy_time * 1000:8.2f}ms  "
+              f"新 {new_time * 1000:8.2f}ms  加速 {legacy_time / new_time:5.1f}x")
+
+
+# ==================== JSON编解码 ====================
+
+def _make_json_task_case(rng):
+    """一个典型报价任务涉及的JSON：报价结果字符串、报价请求体、带附件的产品详情响应"""
+    quotation_result, country_mapping, country_variants = _make_quotation_case(rng, 200, 1000)
+    quotation_result_str = json.dumps(quotation_result)
+
+    compiled = V1.CompiledQuotation(quotation_result)
+    price_params = compiled.price_params(country_mapping, country_variants)[0]
+    quotation_payload = {"product_id": 1, "shopify_product_id": 2, "is_quotation_product": 2, **price_params}
+
+    detail_response = json.dumps({
+        "success": True,
+        "data": [{
+            "product_id": 1,
+            "quotation_information": {
+                nation: [dict(variant, country_id=country_id, title="变体标题 " * 4) for variant in country_variants[nation]]
+                for nation, country_id in country_mapping.items()
+            },
+            "attachments": [{"name": f"{index}.jpg", "data": base64.b64encode(rng.randbytes(256 * 1024)).decode()}
+                            for index in range(8)],
+        }]
+    }).encode('utf-8')
+    return quotation_result_str, quotation_payload, detail_response
+
+
+def _json_task_stdlib(quotation_result_str, quotation_payload, detail_response):
+    """优化前：标准库 json（requests 的 json= 和 response.json() 也是标准库）"""
+    json.loads(quotation_result_str)
+    json.dumps(quotation_payload).encode('utf-8')
+    json.loads(detail_response)
+
+
+def _json_task_codec(quotation_result_str, quotation_payload, detail_response):
+    """V1 的编解码层"""
+    V1.json_loads(quotation_result_str)
+    V1.json_dumps_bytes(quotation_payload)
+    V1.json_loads(detail_response)
+
+
+def bench_json_codec():
+    """每个报价任务的JSON编解码CPU耗时：标准库 vs 编解码层（安装orjson时使用orjson）"""
+    rng = random.Random(24)
+    case = _make_json_task_case(rng)
+    quotation_result_str, quotation_payload, detail_response = case
+
+    assert V1.json_loads(V1.json_dumps_bytes(quotation_payload)) == quotation_payload
+    assert V1.json_loads(detail_response) == json.loads(detail_response)
+
+    def cpu_time(func):
+        best = None
+        for _ in range(5):
+            start = time.process_time()
+            func(*case)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    backend = "orjson" if V1.orjson is not None else "标准库（未安装orjson）"
+    stdlib_time = cpu_time(_json_task_stdlib)
+    codec_time = cpu_time(_json_task_codec)
+    print(f"json_codec 报价参数 {len(quotation_payload) - 3} 个, 详情响应 {len(detail_response) / 1024 / 1024:.1f} MB")
+    print(f"json_codec 每任务CPU: 标准库 {stdlib_time * 1000:8.2f}ms  编解码层[{backend}] {codec_time * 1000:8.2f}ms  "
+          f"节省 {(stdlib_time - codec_time) * 1000:8.2f}ms")
+
+
+BENCHMARKS = {
+    "store_match": bench_store_match,
+    "quotation_compile": bench_quotation_compile,
+    "json_codec": bench_json_codec,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"未知基准: {name}，可选: {', '.join(BENCHMARKS)}")
+            continue
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])